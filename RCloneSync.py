@@ -8,6 +8,23 @@
 #
 #  Chris Nelson, August 2017
 #
+# 261018  Run journal:  an interrupted run is resumed from its plan on the next run.  Stale lock files of dead runs are removed.
+# 261018  Added --Config and --LockFile:  many Remote/Local pairs from one INI file, synced by a worker pool with per-pair locks.
+# 261018  Added --WorkDir, and benchmarks/bench_sync.py:  whole runs against synthetic trees, offline with a stand-in rclone.
+# 261018  Added --TargetedPush and --ReconcileEvery:  upload/delete only the changed paths, with a full rclone sync every Nth run.
+# 261018  Added --LsJson and --HashType:  listings from rclone lsjson, with content hashes kept in the prior listings (snapshot version 2).
+# 261018  Added --DetectMoves and --MoveHash:  files moved on one side are moved on the other with rclone moveto, not copied again.
+# 261018  Per-phase timing, subprocess and file/byte counts for each run, appended to <remote>_metrics.jsonl.  Added --PromFile.
+# 261018  Added --StreamBuffer:  streaming mode with the Now listings sorted on disk, for bounded memory on very large trees.
+# 261018  Added --Daemon, --DaemonInterval and --RemoteInterval:  stay running with the listings in memory, Local changes tracked with inotify.
+# 261018  Added --QuickCheck:  skip the run when a cheap check of both sides finds nothing changed since the last full run.
+# 261018  Added --Sharded, --ShardDirs and --ShardWorkers:  shards listed, diffed and synced by a worker pool, each with its own prior listings.
+# 261018  Local and Remote trees listed concurrently, rclone lsl output streamed straight into the parser.
+# 261018  Local and Remote deltas found by dict lookups in memory, or one merge pass over a snapshot.  Added benchmarks/bench_deltas.py.
+# 261018  Prior sync listings kept as versioned, checksummed binary snapshots (memory-mapped).  Added --ExportLists.
+# 261018  Faster lsl parsing (per-date cached time conversion) into compact FileList/FileEntry records.  Added benchmarks/bench_loadList.py.
+# 261018  lsl files for the next run updated from this run's listings and operations, rather than re-listed.  Added --FullRelist.
+# 261018  Remote to Local copies batched into one rclone copy (--files-from) per direction, with --Transfers and --Checkers.
 # 170805  Added --Verbose command line switch 
 # 170730  Horrible bug - remote lsl failing results in deleting all local files, and then iteratively replicating _LOCAL and _REMOTE files.
 #       Added connection test/checking files to abort if the basic connection is down.  RCLONE_TEST files on the local system
@@ -27,14 +44,25 @@
 #==========================================================
 
 import argparse
+import calendar
+import errno
 import sys
-import re
 import os.path, subprocess
-from datetime import datetime
+import shutil
 import time
 import shlex
+import select
+import signal
+import stat
 import logging
-import collections                          # dictionary sorting 
+import gc
+import heapq
+import json
+import mmap
+import struct
+import tempfile
+import threading
+import zlib
 
 localWD =    "/home/xxx/RCloneSyncWD/"      # File lists for the local and remote trees as of last sync, etc. 
 
@@ -42,123 +70,180 @@ logging.basicConfig(format='%(asctime)s/%(levelname)s:  %(message)s')   # /%(mod
 
 
 def main():
+    global metrics, reconcileRun
+    metrics = RunMetrics ()
+    reconcileRun = reconcileDue ()
 
-    excludes = ' '
-    if exclusions:
-        if not os.path.exists(exclusions):
-            logging.error ("Specified Exclusions file does not exist:  " + exclusions)
-            return 1
-        excludes = " --exclude-from " + exclusions + ' '
-
-    localListFile  = localWD + remoteName[0:-1] + '_localLSL'          # Delete the ':' on the end
-    remoteListFile = localWD + remoteName[0:-1] + '_remoteLSL'
-
-    _dryRun = ' '
-    if dryRun:
-        _dryRun = '--dry-run'       # string used on rclone invocations
-        if os.path.exists (localListFile):
-            subprocess.call (['cp', localListFile, localListFile + 'DRYRUN'])
-            localListFile  += 'DRYRUN'
-        if os.path.exists (remoteListFile):
-            subprocess.call (['cp', remoteListFile, remoteListFile + 'DRYRUN'])
-            remoteListFile += 'DRYRUN'
+    excludeSwitches = getExcludeSwitches ()
+    if excludeSwitches is None:
+        return 1
 
+    runStart = time.time()
+    if quickCheckRuns and not firstSync and not journalPending ():
+        metrics.phase ('quickCheck')
+        if quickCheck (excludeSwitches):
+            metrics.count ('quickCheckSkipped')
+            return 0
 
-    # ***** Generate initial local and remote file lists, and copy any unique Remote files to Local *****
-    if firstSync:
-        logging.info (">>>>> Generating --FirstSync Local and Remote lists")
-        try:
-            with open(localListFile, "w") as of:
-                subprocess.call(shlex.split("rclone lsl " + localRoot + excludes), stdout=of)
-        except:
-            logging.error (printMsg ("*****", "Specified --LocalRoot invalid?", "<{}>".format(localRoot)))
-            return 1
+    metrics.phase ('healthCheck')
+    if healthCheck () is None:
+        return 1
 
-        try:
-            with open(remoteListFile, "w") as of:
-                subprocess.call(shlex.split("rclone lsl " + remoteNameSP + excludes), stdout=of)
-        except:
-            logging.error (printMsg ("*****", "Specified --Cloud invalid?", remoteName))
+    if sharded:
+        rc = syncShards ()
+    else:
+        metrics.phase ('relayout')
+        listBase = unshardPriors ()
+        if listBase is None:
             return 1
+        rc, synced = syncTree ('', listBase, excludeSwitches)
+        if synced:
+            metrics.phase ('rmdirs')
+            removeEmptyDirs (remoteName, localRoot)
+    metrics.phase (None)
 
-        localNow  = loadList (localListFile)
-        remoteNow = loadList (remoteListFile)
+    if rc == 0 and not dryRun:
+        writeQuickState (runStart, time.time() - runStart, 0)
+        if targetedPush:
+            writePushRuns (reconcileRun or firstSync)
+    return rc
 
-        for key in remoteNow:
-            if key not in localNow:
-                src  = '"' + remoteName + key + '" '           # Extra space for shlex.split
-                dest = '"' + localRoot + '/' + key + '" '
-                logging.info (printMsg ("REMOTE", "  Copying to local", dest))
-                subprocess.call(shlex.split("rclone copyto " + src + dest + _dryRun))
 
-        with open(localListFile, "w") as of:            # Update local list file, then fall into regular sync
-            subprocess.call(shlex.split("rclone lsl " + localRootSP + excludes), stdout=of)
+def getExcludeSwitches ():
+    excludes = ' '
+    if exclusions:
+        if not os.path.exists(exclusions):
+            logging.error ("Specified Exclusions file does not exist:  " + exclusions)
+            return None
+        excludes = " --exclude-from " + exclusions + ' '
+    return shlex.split(excludes)
 
 
+def healthCheck ():
     # ***** Check basic health of access to the local and remote filesystems *****
+    # Returns the paths of the check files, or None if the check failed
     logging.info (">>>>> Checking rclone Local and Remote access health")
-    localChkListFile  = localWD + remoteName[0:-1] + '_localChkLSL'          # Delete the ':' on the end
-    remoteChkListFile = localWD + remoteName[0:-1] + '_remoteChkLSL'
     chkFile = 'RCLONE_TEST'
 
     try:
-        with open(localChkListFile, "w") as of:
-            subprocess.call(shlex.split("rclone lsl " + localRootSP + '--include ' + chkFile), stdout=of)
-    except:
-        logging.error (printMsg ("*****", "Specified --LocalRoot invalid?", "<{}>".format(localRoot)))
-        return 1
-
-    try:
-        with open(remoteChkListFile, "w") as of:
-            subprocess.call(shlex.split("rclone lsl " + remoteNameSP + '--include ' + chkFile), stdout=of)
-    except:
-        logging.error (printMsg ("*****", "Specified --Cloud invalid?", remoteName))
-        return 1
-
-    localCheck  = loadList (localChkListFile)
-    remoteCheck = loadList (remoteChkListFile)
+        localCheck, remoteCheck = listTrees ((localRoot, ['--include', chkFile]), (remoteName, ['--include', chkFile]))
+    except IOError as e:
+        logging.error (printMsg ("*****", "Specified --LocalRoot or --Cloud invalid?", e))
+        return None
 
     if len(localCheck) < 1 or len(localCheck) != len(remoteCheck):
         logging.error (printMsg ("*****", "Failed access health test:  <{}> local count {}, remote count {}"
                                  .format(chkFile, len(localCheck), len(remoteCheck)), ""))
-        return 1
+        return None
     else:
         for key in localCheck:
             logging.debug ("Check key " + key)
             if key not in remoteCheck:
                 logging.error (printMsg ("*****", "Failed access health test:  Local key <{}> not found in remote".format(key), ""))
-                return 1
+                return None
+    return list(localCheck)
+
+
+def unshardPriors ():
+    # An unsharded run after a sharded one merges the shards' prior listings back into whole-tree listings.  Returns
+    # the base of the prior listings to sync against (see relayoutPriors), or None on error.
+    wholeBase = localWD + remoteName[0:-1]
+    if os.path.isdir(wholeBase + '_shards/'):
+        if firstSync:
+            if not dryRun:
+                shutil.rmtree(wholeBase + '_shards/')
+            return wholeBase
+        try:
+            return relayoutPriors (None)
+        except (IOError, ValueError) as e:
+            logging.error (printMsg ("*****", "Prior sync listing unusable - Run with --FirstSync", e))
+            return None
+    return wholeBase
+
+
+def syncTree (label, listBase, filterSwitches, listings=None):
+    # List, diff and sync one tree:  the whole of LocalRoot/Cloud, or one shard of it.  filterSwitches are the rclone
+    # filters that scope the tree, and the prior sync listings are <listBase>_localLSL and <listBase>_remoteLSL.
+    # listings (a TreeListings) supplies listings already in memory in place of listing or loading them, and gets
+    # the new prior listings back.  Returns the error status and whether a full rclone sync was run (the caller
+    # then removes empty directories).
+    if listings is None:
+        listings = TreeListings ()
+
+    localListFile  = listBase + '_localLSL'
+    remoteListFile = listBase + '_remoteLSL'
+
+    if dryRun:                      # Work on copies, so that the real prior listings are left as they are
+        if os.path.exists (localListFile):
+            runCommand (['cp', localListFile, localListFile + 'DRYRUN'])
+        elif os.path.exists (localListFile + 'DRYRUN'):
+            os.remove (localListFile + 'DRYRUN')
+        if os.path.exists (remoteListFile):
+            runCommand (['cp', remoteListFile, remoteListFile + 'DRYRUN'])
+        elif os.path.exists (remoteListFile + 'DRYRUN'):
+            os.remove (remoteListFile + 'DRYRUN')
+        localListFile  += 'DRYRUN'
+        remoteListFile += 'DRYRUN'
 
-    os.remove(localChkListFile)
-    os.remove(remoteChkListFile)
-    
+    nowFiles = (None, None)                             # Where streaming mode sorts the Now listings to
+    if streamBuffer:
+        nowFiles = (listBase + '_localNow', listBase + '_remoteNow')
 
-    # ***** Get current listings of the local and remote trees *****
-    logging.info (">>>>> Generating Local and Remote lists")
+    resumed = resumeTree (label, listBase, filterSwitches, listings, nowFiles)
+    if resumed is not None:
+        return resumed
 
-    localListFileNew = localWD + remoteName[0:-1] + '_localLSL_new'
-    try:
-        with open(localListFileNew, "w") as of:
-            subprocess.call(shlex.split("rclone lsl " + localRootSP + excludes), stdout=of)
-    except:
-        logging.error (printMsg ("*****", "Specified --LocalRoot invalid?", "<{}>".format(localRoot)))
-        return 1
+    # ***** Generate initial local and remote file lists, and copy any unique Remote files to Local *****
+    if firstSync:
+        metrics.phase ('firstSync')
+        logging.info (">>>>> " + label + "Generating --FirstSync Local and Remote lists")
+        try:
+            localNow, remoteNow = listTrees ((localRoot, filterSwitches, nowFiles[0]), (remoteName, filterSwitches, nowFiles[1]))
+        except IOError as e:
+            logging.error (printMsg ("*****", "Specified --LocalRoot or --Cloud invalid?", e))
+            return 1, False
+
+        toLocal = [key for key, (local, remote) in mergeItems (localNow.items(), remoteNow.items()) if local is None]
+        copyToLocal (listBase, toLocal, [], remoteNow)
 
-    remoteListFileNew = localWD + remoteName[0:-1] + '_remoteLSL_new'
+        try:                                            # Update local list file, then fall into regular sync
+            localNow, = listTrees ((localRoot, filterSwitches, nowFiles[0]))
+        except IOError as e:
+            logging.error (printMsg ("*****", "Specified --LocalRoot invalid?", e))
+            return 1, False
+        saveListing (localListFile, localNow)
+        saveListing (remoteListFile, remoteNow)
+
+
+    # ***** Get current listings of the local and remote trees *****
+    # Both trees are listed at once, each streamed straight into the parser.  A failure on either side aborts here,
+    # before any change is applied.
+    metrics.phase ('list')
+    logging.info (">>>>> " + label + "Generating Local and Remote lists")
+    localNow, remoteNow = listings.localNow, listings.remoteNow
     try:
-        with open(remoteListFileNew, "w") as of:
-            subprocess.call(shlex.split("rclone lsl " + remoteNameSP + excludes), stdout=of)
-    except:
-        logging.error (printMsg ("*****", "Specified --Cloud invalid?", localRoot))
-        return 1
+        if localNow is None and remoteNow is None:
+            localNow, remoteNow = listTrees ((localRoot, filterSwitches, nowFiles[0]), (remoteName, filterSwitches, nowFiles[1]))
+        elif localNow is None:
+            localNow, = listTrees ((localRoot, filterSwitches, nowFiles[0]))
+        elif remoteNow is None:
+            remoteNow, = listTrees ((remoteName, filterSwitches, nowFiles[1]))
+    except IOError as e:
+        logging.error (printMsg ("*****", "Specified --LocalRoot or --Cloud invalid?", e))
+        return 1, False
 
 
     # ***** Load Current and Prior listings of both Local and Remote trees *****
-    localPrior = loadList (localListFile)
-    remotePrior = loadList (remoteListFile)
-
-    localNow = loadList (localListFileNew)
-    remoteNow = loadList (remoteListFileNew)
+    metrics.phase ('loadPrior')
+    try:
+        localPrior = listings.localPrior if listings.localPrior is not None else loadPrior (localListFile)
+        remotePrior = listings.remotePrior if listings.remotePrior is not None else loadPrior (remoteListFile)
+    except (IOError, ValueError) as e:
+        logging.error (printMsg ("*****", "Prior sync listing unusable - Run with --FirstSync", e))
+        return 1, False
+    if hashType:
+        metrics.phase ('hashLocal')
+        localNow = hashLocal (localPrior, localNow, listBase)
 
 
     # ***** Check both local and remote for change relative to the last sync *****
@@ -177,160 +262,469 @@ def main():
     #    ^  'newerBoth'         Both local and remote have newer versions than prior sync.  Copy remote to local with _REMOTE.
 
 
-    # ***** Check for LOCAL deltas relative to the prior sync
+    # ***** Check for LOCAL and REMOTE deltas relative to the prior sync
+    metrics.phase ('diff')
+    localDeltas, remoteDeltas = findDeltas (localPrior, localNow, remotePrior, remoteNow)
+    metrics.count ('localFiles', len(localNow))
+    metrics.count ('remoteFiles', len(remoteNow))
+    metrics.count ('localChanges', len(localDeltas))
+    metrics.count ('remoteChanges', len(remoteDeltas))
+
     logging.info (printMsg ("LOCAL", "Checking for Diffs", localRoot))
-    localDeltas = {}
-    for key in localPrior:
-        _newer=False; _older=False; _size=False; _deleted=False
-        if key not in localNow:
-            logging.info (printMsg ("LOCAL", "  File was deleted", key))
-            _deleted=True            
-        else:
-            if localPrior[key]['datetime'] != localNow[key]['datetime']:
-                if localPrior[key]['datetime'] < localNow[key]['datetime']:
-                    logging.info (printMsg ("LOCAL", "  File is newer", key))
-                    _newer=True
-                else:               # Now local version is older than prior sync
-                    logging.info (printMsg ("LOCAL", "  File is OLDER", key))
-                    _older=True
-            if localPrior[key]['size'] != localNow[key]['size']:
-                logging.info (printMsg ("LOCAL", "  File size is different", key))
-                _size=True
-
-        if _newer or _older or _size or _deleted:
-            localDeltas[key] = {'new':False, 'newer':_newer, 'older':_older, 'size':_size, 'deleted':_deleted}
-
-    for key in localNow:
-        if key not in localPrior:
-            logging.info (printMsg ("LOCAL", "  File is new", key))
-            localDeltas[key] = {'new':True, 'newer':False, 'older':False, 'size':False, 'deleted':False}
-
-    localDeltas = collections.OrderedDict(sorted(localDeltas.items()))      # sort the deltas list
+    logDeltas ("LOCAL", localDeltas)
     if len(localDeltas) > 0:
         logging.warning ("  {:4} file change(s) on the Local system {}".format(len(localDeltas), localRoot))
 
-
-    # ***** Check for REMOTE deltas relative to the last sync
     logging.info (printMsg ("REMOTE", "Checking for Diffs", remoteName))
-    remoteDeltas = {}
-    for key in remotePrior:
-        _newer=False; _older=False; _size=False; _deleted=False
-        if key not in remoteNow:
-            logging.info (printMsg ("REMOTE", "  File was deleted", key))
-            _deleted=True            
-        else:
-            if remotePrior[key]['datetime'] != remoteNow[key]['datetime']:
-                if remotePrior[key]['datetime'] < remoteNow[key]['datetime']:
-                    logging.info (printMsg ("REMOTE", "  File is newer", key))
-                    _newer=True
-                else:               # Now remote version is older than prior sync 
-                    logging.info (printMsg ("REMOTE", "  File is OLDER", key))
-                    _older=True
-            if remotePrior[key]['size'] != remoteNow[key]['size']:
-                logging.info (printMsg ("REMOTE", "  File size is different", key))
-                _size=True
-
-        if _newer or _older or _size or _deleted:
-            remoteDeltas[key] = {'new':False, 'newer':_newer, 'older':_older, 'size':_size, 'deleted':_deleted}
-
-    for key in remoteNow:
-        if key not in remotePrior:
-            logging.info (printMsg ("REMOTE", "  File is new", key))
-            remoteDeltas[key] = {'new':True, 'newer':False, 'older':False, 'size':False, 'deleted':False}
-
-    remoteDeltas = collections.OrderedDict(sorted(remoteDeltas.items()))    # sort the deltas list
+    logDeltas ("REMOTE", remoteDeltas)
     if len(remoteDeltas) > 0:
         logging.warning ("  {:4} file change(s) on {}".format(len(remoteDeltas), remoteName))
 
 
-    # ***** Update LOCAL with all the changes on REMOTE *****
+    # ***** Plan the changes *****
+    # Which Remote changes go to Local, and which conflicts need _LOCAL and _REMOTE copies.  Nothing is changed on
+    # either side until the plan is in the run journal (see applyPlan).
+    metrics.phase ('toLocal')
     if len(remoteDeltas) == 0:
-        logging.info (">>>>> No changes on Remote - Skipping ahead")
+        logging.info (">>>>> " + label + "No changes on Remote - Skipping ahead")
     else:
-        logging.info (">>>>> Applying changes on Remote to Local")
+        logging.info (">>>>> " + label + "Applying changes on Remote to Local")
+
+    toLocal       = []          # Remote files copied to the same name on local
+    toLocalRemote = []          # Remote files copied to local as <key>_REMOTE (conflicts)
+    localCopies   = []          # Local files copied to <key>_LOCAL
+    localMoves    = []          # Local files renamed to <key>_LOCAL
+    localDeletes  = []          # Local files deleted
+    movedLocal    = []          # Local files moved to follow a move on Remote, as (old, new)
+    movedRemote   = []          # Remote files moved to follow a move on Local, as (old, new)
+
+    if detectMoves:
+        remoteMoved = findMoves (remoteDeltas, remotePrior, remoteNow, localDeltas, localNow)
+        localMoved = findMoves (localDeltas, localPrior, localNow, remoteDeltas, remoteNow)
+        if moveHash:
+            remoteMoved = verifyMoves (remoteMoved, remoteName, localRoot, listBase) if remoteMoved else remoteMoved
+            localMoved = verifyMoves (localMoved, localRoot, remoteName, listBase) if localMoved else localMoved
+        movedLocal = [(remoteMoved[new], new) for new in sorted(remoteMoved)]
+        movedRemote = [(localMoved[new], new) for new in sorted(localMoved)]
+    moved = set(key for pair in movedLocal + movedRemote for key in pair)
+    localPrior.close()
+    remotePrior.close()
 
     for key in remoteDeltas:
-        if remoteDeltas[key]['new']:
+        if key in moved:
+            continue
+        if remoteDeltas[key] & deltaNew:
             #logging.info (printMsg ("REMOTE", "  New file", key))
             if key not in localNow: #localDeltas:
-                src  = '"' + remoteName + key + '" '
-                dest = '"' + localRoot + '/' + key + '" '
-                logging.info (printMsg ("REMOTE", "  Copying to local", dest))
-                subprocess.call(shlex.split("rclone copyto " + src + dest + _dryRun))
+                toLocal.append (key)
+            elif sameContent (localNow[key], remoteNow[key]):
+                logging.info (printMsg ("", "  Same content on both sides", key))
             else:
-                src  = '"' + remoteName + key + '" '
-                dest = '"' + localRoot + '/' + key + '_REMOTE' + '" '
                 logging.warning (printMsg ("*****", "  Changed in both local and remote", key))
-                logging.warning (printMsg ("REMOTE", "  Copying to local", dest))
-                subprocess.call(shlex.split("rclone copyto " + src + dest + _dryRun))
-                # Rename local
-                src  = '"' + localRoot + '/' + key + '" '
-                dest = '"' + localRoot + '/' + key + '_LOCAL' + '" '
-                logging.warning (printMsg ("LOCAL", "  Renaming local copy", dest))
-                subprocess.call(shlex.split("rclone copyto " + src + dest + _dryRun))
+                toLocalRemote.append (key)
+                localCopies.append (key)            # Rename local
              # else handler:  If also local new and not matching then create _REMOTE and _LOCAL versions
 
-        if remoteDeltas[key]['newer']:
+        if remoteDeltas[key] & (deltaNewer | deltaHash):
             #logging.info (printMsg ("REMOTE", "  Newer file", key))
             if key not in localDeltas:
-                src  = '"' + remoteName + key + '" '
-                dest = '"' + localRoot + '/' + key + '" '
-                logging.info (printMsg ("REMOTE", "  Copying to local", dest))
-                subprocess.call(shlex.split("rclone copyto " + src + dest + _dryRun))
+                toLocal.append (key)
+            elif key in localNow and sameContent (localNow[key], remoteNow[key]):
+                logging.info (printMsg ("", "  Same content on both sides", key))
             else:
-                src  = '"' + remoteName + key + '" '
-                dest = '"' + localRoot + '/' + key + '_REMOTE' + '" '
                 logging.warning (printMsg ("*****", "  Changed in both local and remote", key))
-                logging.warning (printMsg ("REMOTE", "  Copying to local", dest))
-                subprocess.call(shlex.split("rclone copyto " + src + dest + _dryRun))
+                toLocalRemote.append (key)
                 # Also rename the local to _LOCAL
 
-        if remoteDeltas[key]['deleted']:
+        if remoteDeltas[key] & deltaDeleted:
             #logging.info (printMsg ("REMOTE", "  File was deleted", key))
             if key not in localDeltas:
                 if key in localNow:
-                    src  = '"' + localRoot + '/' + key + '" '
-                    logging.info (printMsg ("LOCAL", "  Deleting file", src))
-                    subprocess.call(shlex.split("rclone delete " + src + _dryRun))
+                    localDeletes.append (key)
             else:  # Changed locally too
                 if key in localNow:
-                    src  = '"' + localRoot + '/' + key + '" '
-                    dest = '"' + localRoot + '/' + key + '_LOCAL' + '" '
                     logging.warning (printMsg ("*****", "  Also changed locally", key))
-                    logging.warning (printMsg ("LOCAL", "  Renaming local", dest))
-                    subprocess.call(shlex.split("rclone moveto " + src + dest + _dryRun))
+                    localMoves.append (key)
 
     for key in localDeltas:
-        if localDeltas[key]['deleted']:
+        if localDeltas[key] & deltaDeleted:
             if (key in remoteDeltas) and (key in remoteNow):
-                src  = '"' + remoteName + key + '"'
-                dest = '"' + localRoot + '/' + key + '_REMOTE' + '"'
                 logging.warning (printMsg ("*****", "  Deleted locally and also changed remotely", key))
-                logging.warning (printMsg ("REMOTE", "  Copying to local", dest))
-                subprocess.call(shlex.split("rclone copyto " + src + dest + _dryRun))
+                toLocalRemote.append (key)
+
+    plan = {'toLocal': toLocal, 'toLocalRemote': toLocalRemote, 'localCopies': localCopies, 'localMoves': localMoves,
+            'localDeletes': localDeletes, 'movedLocal': movedLocal, 'movedRemote': movedRemote,
+            'localDeltas': localDeltas, 'remoteDeltas': remoteDeltas, 'fullSync': firstSync or reconcileRun}
+    return applyPlan (label, listBase, filterSwitches, listings, localNow, remoteNow, nowFiles, plan)
+
+
+def applyPlan (label, listBase, filterSwitches, listings, localNow, remoteNow, nowFiles, plan, resumed=None):
+    # Carry out a plan from syncTree, then write the new prior listings.  The plan goes into the run journal before
+    # the first change, and each operation is journaled as done.  resumed is the set of operations done by an
+    # interrupted run of the same plan (see resumeTree):  those are skipped, and each of the others is first
+    # checked against Local as it is now.  Returns the same as syncTree.
+    toLocal       = plan['toLocal']
+    toLocalRemote = plan['toLocalRemote']
+    localCopies   = plan['localCopies']
+    localMoves    = plan['localMoves']
+    localDeletes  = plan['localDeletes']
+    localDeltas   = plan['localDeltas']
+    remoteDeltas  = plan['remoteDeltas']
+    movedLocal    = []
+    movedRemote   = []
+    moved = set(key for pair in plan['movedLocal'] + plan['movedRemote'] for key in pair)
+    opsFailed     = False       # Any rclone error makes the incremental lsl update uncertain
+    unsettled     = set()       # Changed since an interrupted run planned them:  left out of the new lsl files
+
+    localListFile  = listBase + '_localLSL'
+    remoteListFile = listBase + '_remoteLSL'
+    _dryRun = ' '
+    if dryRun:
+        _dryRun = '--dry-run'
+        localListFile  += 'DRYRUN'
+        remoteListFile += 'DRYRUN'
+
+    journal = Journal (listBase)
+    done = resumed if resumed is not None else set()
+    if not dryRun:
+        if resumed is not None:
+            journal.reopen ()
+        elif localDeltas or remoteDeltas:
+            journal.start (plan, filterSwitches, localNow, remoteNow)
+
+    def check (key, before, after, paths):
+        # For a resumed run:  'done' if Local is as after the operation, 'todo' if still as before, else 'changed'.
+        # before and after are [(key, entry or None)].
+        if resumed is None:
+            return 'todo'
+        if all(localMatches (k, entry) for k, entry in after):
+            return 'done'
+        if all(localMatches (k, entry) for k, entry in before):
+            return 'todo'
+        logging.warning (printMsg ("*****", "  Changed since the interrupted run - skipped", key))
+        unsettled.update (paths)
+        return 'changed'
+
+    todo = []
+    for old, new in plan['movedLocal']:
+        if 'moveLocal ' + new in done:
+            movedLocal.append ((old, new))
+            continue
+        state = check (old + ' -> ' + new, [(old, localNow[old]), (new, None)],
+                       [(old, None), (new, localNow[old])], (old, new))
+        if state == 'todo':
+            logging.info (printMsg ("LOCAL", "  Moving file as on Remote", old + ' -> ' + new))
+            todo.append ((old, new))
+        elif state == 'done':
+            movedLocal.append ((old, new))
+            journal.done ('moveLocal ' + new)
+    moved = set(moveFiles (localRoot + '/', todo, listBase))
+    for old, new in todo:
+        if (old, new) in moved:
+            movedLocal.append ((old, new))
+            journal.done ('moveLocal ' + new)
+        else:                                   # Left for the next run to see as new on both sides
+            opsFailed = True
+            unsettled.update ((old, new))
+    todo = []
+    listed = None
+    pending = [(old, new) for old, new in plan['movedRemote'] if 'moveRemote ' + new not in done]
+    if resumed is not None and pending:         # The Remote as it is now, for the moves not journaled as done
+        listFile = listBase + '_moveCheck'
+        with open(listFile, 'w') as of:
+            for pair in pending:
+                of.write('/' + pair[0] + '\n/' + pair[1] + '\n')
+        try:
+            listed, = listTrees ((remoteName, filterSwitches + ['--files-from', listFile]))
+        except IOError as e:
+            logging.warning (printMsg ("*****", "Remote check of the moves failed", e))
+            listed = FileList ()
+            opsFailed = True
+        finally:
+            os.remove(listFile)
+    for old, new in plan['movedRemote']:
+        if 'moveRemote ' + new in done:
+            movedRemote.append ((old, new))
+            continue
+        if listed is not None:
+            entry = remoteNow[old]
+            if old not in listed and new in listed and listed[new].size == entry.size:
+                movedRemote.append ((old, new))         # Moved, but its record was lost
+                journal.done ('moveRemote ' + new)
+                continue
+            if new in listed or old not in listed or deltaFlags (entry, listed[old]):
+                logging.warning (printMsg ("*****", "  Changed since the interrupted run - skipped", old + ' -> ' + new))
+                unsettled.update ((old, new))
+                continue
+        logging.info (printMsg ("REMOTE", "  Moving file as on Local", old + ' -> ' + new))
+        todo.append ((old, new))
+    moved = set(moveFiles (remoteName, todo, listBase))
+    for old, new in todo:
+        if (old, new) in moved:
+            movedRemote.append ((old, new))
+            journal.done ('moveRemote ' + new)
+        else:
+            opsFailed = True
+            unsettled.update ((old, new))
+    countTransfers ([new for old, new in movedLocal], remoteNow, 'moved')
+    countTransfers ([new for old, new in movedRemote], localNow, 'moved')
+
+    for key in localCopies:
+        if 'copyLocal ' + key in done:
+            continue
+        if check (key, [(key, localNow[key])], [(key + '_LOCAL', localNow[key])], (key, key + '_LOCAL')) == 'todo':
+            src  = '"' + localRoot + '/' + key + '" '
+            dest = '"' + localRoot + '/' + key + '_LOCAL' + '" '
+            logging.warning (printMsg ("LOCAL", "  Renaming local copy", dest))
+            rc = runCommand(shlex.split("rclone copyto " + src + dest + _dryRun))
+            opsFailed |= rc != 0
+            if rc == 0:
+                journal.done ('copyLocal ' + key)
+    for key in localDeletes:
+        if 'deleteLocal ' + key in done:
+            continue
+        if check (key, [(key, localNow[key])], [(key, None)], (key,)) == 'todo':
+            src  = '"' + localRoot + '/' + key + '" '
+            logging.info (printMsg ("LOCAL", "  Deleting file", src))
+            rc = runCommand(shlex.split("rclone delete " + src + _dryRun))
+            opsFailed |= rc != 0
+            if rc == 0:
+                journal.done ('deleteLocal ' + key)
+    for key in localMoves:
+        if 'moveToLocal ' + key in done:
+            continue
+        if check (key, [(key, localNow[key])], [(key, None), (key + '_LOCAL', localNow[key])],
+                  (key, key + '_LOCAL')) == 'todo':
+            src  = '"' + localRoot + '/' + key + '" '
+            dest = '"' + localRoot + '/' + key + '_LOCAL' + '" '
+            logging.warning (printMsg ("LOCAL", "  Renaming local", dest))
+            rc = runCommand(shlex.split("rclone moveto " + src + dest + _dryRun))
+            opsFailed |= rc != 0
+            if rc == 0:
+                journal.done ('moveToLocal ' + key)
+
+    if 'copyToLocal' not in done:
+        copies = toLocal
+        if resumed is not None:                 # Not over a Local file changed since, unless already copied
+            copies = []
+            for key in toLocal:
+                if localMatches (key, remoteNow[key]) or localMatches (key, localNow[key] if key in localNow else None):
+                    copies.append (key)
+                else:
+                    logging.warning (printMsg ("*****", "  Changed since the interrupted run - skipped", key))
+                    unsettled.add (key)
+        journal.sync ()
+        rc = copyToLocal (listBase, copies, toLocalRemote, remoteNow)
+        opsFailed |= rc != 0
+        if rc == 0:
+            journal.done ('copyToLocal')
+    countTransfers (toLocal + toLocalRemote, remoteNow, 'toLocal')
+    metrics.count ('conflicts', len(set(toLocalRemote)))
+    metrics.count ('localDeletes', len(localDeletes))
+    metrics.count ('localRenames', len(localCopies) + len(localMoves))
 
 
     # ***** Sync LOCAL changes to REMOTE ***** 
-    if len(remoteDeltas) == 0 and len(localDeltas) == 0 and not firstSync:
-        logging.info (">>>>> No changes on Local - Skipping sync from Local to Remote")
-    else:
-        logging.info (">>>>> Synching Local to Remote")
-        if verbose:  syncVerbosity = '--verbose '
-        else:        syncVerbosity = ' '
-        switches = ' ' #'--ignore-size '
-        subprocess.call(shlex.split("rclone sync " + localRootSP + remoteNameSP + syncVerbosity + switches + excludes + _dryRun))
-        subprocess.call(shlex.split("rclone rmdirs " + remoteNameSP + _dryRun))
-        subprocess.call(shlex.split("rclone rmdirs " + localRootSP + _dryRun))
+    # The files where Remote now differs from Local:  Local changes, the <key>_LOCAL and <key>_REMOTE files, and
+    # Remote changes that were not copied to Local (Local wins, as with rclone sync).  Those are all that
+    # --TargetedPush uploads or deletes.
+    synced = False              # Remote made to match Local, by rclone sync or by the targeted push
+    fullSync = False
+    if len(remoteDeltas) == 0 and len(localDeltas) == 0 and not firstSync and not (targetedPush and plan['fullSync']):
+        logging.info (">>>>> " + label + "No changes on Local - Skipping sync from Local to Remote")
+    else:                               # With --TargetedPush a reconciling run syncs even with no changes
+        localGone = set(localDeletes) | set(localMoves) | set(old for old, new in movedLocal)
+        fetched = set(toLocal) | moved
+        uploads = [key for key in localDeltas if not localDeltas[key] & deltaDeleted and key not in moved and key not in localGone]
+        uploads += [key for key in remoteDeltas if key not in fetched and key not in localDeltas and key in localNow and key not in localGone]
+        deletes = [key for key in localDeltas if localDeltas[key] & deltaDeleted and key not in moved]
+        countTransfers (uploads, localNow, 'toRemote')
+        countTransfers (localCopies + localMoves, localNow, 'toRemote')     # The <key>_LOCAL files
+        countTransfers (toLocalRemote, remoteNow, 'toRemote')               # The <key>_REMOTE files
+        metrics.count ('remoteDeletes', len(deletes))
+
+        journal.sync ()
+        step = 'sync' if plan['fullSync'] else 'push'
+        rc = 0
+        if step not in done and plan['fullSync']:
+            metrics.phase ('sync')
+            logging.info (">>>>> " + label + "Synching Local to Remote")
+            if verbose:  syncVerbosity = '--verbose '
+            else:        syncVerbosity = ' '
+            switches = ' ' #'--ignore-size '
+            excludeFile = []
+            if unsettled:                       # Neither side's version is overwritten or deleted
+                with open(listBase + '_unsettled', 'w') as of:
+                    for key in sorted(unsettled):
+                        of.write('/' + ''.join('\\' + c if c in '\\*?[]{}' else c for c in key) + '\n')
+                excludeFile = ['--exclude-from', listBase + '_unsettled']
+            rc = runCommand(['rclone', 'sync', localRoot, remoteName] + shlex.split(syncVerbosity + switches) +
+                            excludeFile + filterSwitches + shlex.split(_dryRun))
+            if excludeFile:
+                os.remove(listBase + '_unsettled')
+        elif step not in done:
+            metrics.phase ('push')
+            logging.info (">>>>> " + label + "Pushing Local changes to Remote")
+            uploads += [key + '_LOCAL' for key in localCopies + localMoves] + [key + '_REMOTE' for key in toLocalRemote]
+            deletes = [key for key in deletes if key in remoteNow]
+            uploads = [key for key in uploads if key not in unsettled]
+            deletes = [key for key in deletes if key not in unsettled]
+            if resumed is not None:             # Only what is still as planned on Local
+                for key in [key for key in uploads if not os.path.isfile(localRoot + '/' + key)]:
+                    uploads.remove (key)
+                    unsettled.add (key)
+                for key in [key for key in deletes if not localMatches (key, None)]:
+                    deletes.remove (key)
+                    unsettled.add (key)
+            rc = pushToRemote (listBase, uploads, deletes, filterSwitches)
+            if not dryRun:
+                pruneDirs ([key for key in localDeltas if localDeltas[key] & deltaDeleted] + list(localGone),
+                           listBase, filterSwitches)
+        opsFailed |= rc != 0
+        if rc == 0:
+            journal.done (step)
+        fullSync = plan['fullSync']
+        synced = True
 
 
     # ***** Clean up *****
-    logging.info (">>>>> Refreshing Local and Remote lsl files")
-    os.remove(remoteListFileNew)
-    os.remove(localListFileNew)
-    with open(localListFile, "w") as of:
-        subprocess.call(shlex.split("rclone lsl " + localRootSP + excludes), stdout=of)
-    with open(remoteListFile, "w") as of:
-        subprocess.call(shlex.split("rclone lsl " + remoteNameSP + excludes), stdout=of)
+    # The new lsl files are built from localNow/remoteNow plus the operations performed above.  A side is only
+    # re-listed with a full rclone lsl if --FullRelist is given or the result of an operation there is uncertain.
+    metrics.phase ('cleanup')
+    logging.info (">>>>> " + label + "Refreshing Local and Remote lsl files")
+
+    newLocal = newRemote = None
+    if dryRun:                                          # Nothing was changed on either side
+        newLocal, newRemote = localNow, remoteNow
+    elif not fullRelist and not opsFailed and not unsettled:
+        touched = set(localDeltas) | (set(remoteDeltas) - set(toLocal))
+        touched.update (key + '_LOCAL' for key in localCopies + localMoves)
+        touched.update (key + '_REMOTE' for key in toLocalRemote)
+        if not streamBuffer:
+            newLocal = updateLocalList (localNow, remoteNow, toLocal, toLocalRemote, localCopies, localMoves, localDeletes, movedLocal)
+            if newLocal is not None:
+                newRemote = remoteNow if not synced else updateRemoteList (listBase, newLocal, remoteNow, touched, filterSwitches, plan['fullSync'])
+        elif streamLocalList (localNow, remoteNow, (toLocal, toLocalRemote, localCopies, localMoves, localDeletes, movedLocal), localListFile):
+            newLocal = SnapshotList (localListFile)
+            if not synced:
+                newRemote = remoteNow
+            elif streamRemoteList (listBase, newLocal, remoteNow, touched, filterSwitches, plan['fullSync'], remoteListFile):
+                newRemote = SnapshotList (remoteListFile)
+
+    relist = []
+    if newLocal is None:
+        logging.info (printMsg ("LOCAL", "Full re-list", localRoot))
+        relist.append ((localRoot, filterSwitches, nowFiles[0]))
+    if newRemote is None:
+        logging.info (printMsg ("REMOTE", "Full re-list", remoteName))
+        relist.append ((remoteName, filterSwitches, nowFiles[1]))
+    try:
+        relisted = listTrees (*relist)
+    except IOError as e:
+        logging.error (printMsg ("*****", "Re-list failed.  lsl files not updated.", e))
+        journal.close ()
+        return 1, fullSync
+    if newLocal is None:
+        newLocal = relisted.pop(0)
+    if newRemote is None:
+        newRemote = relisted.pop(0)
+    if unsettled:                                       # To be seen as new on both sides by the next run
+        newLocal = withoutKeys (newLocal, unsettled, localListFile + '_new')
+        newRemote = withoutKeys (newRemote, unsettled, remoteListFile + '_new')
+    saveListing (localListFile, newLocal)
+    saveListing (remoteListFile, newRemote)
+    journal.finish ()
+    if streamBuffer:
+        for listing in (localNow, remoteNow):
+            listing.close()
+        for nowFile in nowFiles:
+            if os.path.exists(nowFile):
+                os.remove(nowFile)
+    else:
+        listings.localPrior = newLocal if isinstance(newLocal, FileList) else FileList (newLocal)
+        listings.remotePrior = newRemote if isinstance(newRemote, FileList) else FileList (newRemote)
+
+    if opsFailed:                                       # The lsl files were re-listed, but the run is not complete
+        logging.error (printMsg ("*****", "Some rclone operations failed", label.strip() or remoteName))
+        return 1, fullSync
+    return 0, fullSync
+
+
+def saveListing (listFile, listing):
+    # Write a listing as the prior sync snapshot.  A snapshot from streaming mode is renamed into place.
+    if isinstance(listing, SnapshotList):
+        listing.close()
+        os.rename(listing.path, listFile)
+    else:
+        writeSnapshot (listFile, listing)
+
+
+def updateLocalList (localNow, remoteNow, toLocal, toLocalRemote, localCopies, localMoves, localDeletes, movedLocal):
+    # Apply this run's Local operations to the Local listing.  Copied and renamed files keep the modtime of their
+    # source, so their entries are carried over.  Returns None if a file did not arrive as expected.
+    newLocal = dict(localNow)
+    for key in localDeletes:
+        newLocal.pop(key, None)
+    for old, new in movedLocal:
+        newLocal[new] = newLocal.pop(old)
+    for key in localCopies:
+        newLocal[key + '_LOCAL'] = localNow[key]
+    for key in localMoves:
+        newLocal[key + '_LOCAL'] = newLocal.pop(key)
+    created = {}
+    for key in toLocal:
+        created[key] = remoteNow[key]
+    for key in toLocalRemote:
+        created[key + '_REMOTE'] = remoteNow[key]
+    for key in created:
+        path = localRoot + '/' + key
+        if not os.path.isfile(path) or os.path.getsize(path) != created[key]['size']:
+            logging.warning (printMsg ("LOCAL", "  Copied file not as expected", key))
+            return None
+    newLocal.update (created)
+    return newLocal
+
+
+def updateRemoteList (listBase, newLocal, remoteNow, touched, filterSwitches, fullSync):
+    # After rclone sync the Remote holds the same files as Local.  Untouched files keep their remoteNow entries.
+    # Files that were uploaded or may have been re-uploaded get their Remote modtime from a targeted rclone lsl,
+    # since not all remotes retain the modtime of an upload.  After a full rclone sync that includes any file whose
+    # Remote modtime differs from Local, which the sync may have set or re-uploaded.  Returns None if that lookup
+    # is incomplete.
+    newRemote = {}
+    uncertain = []
+    for key in newLocal:
+        if key in remoteNow and key not in touched and remoteNow[key]['size'] == newLocal[key]['size'] and \
+                not (fullSync and remoteNow[key]['datetime'] != newLocal[key]['datetime']):
+            newRemote[key] = remoteNow[key]
+        else:
+            uncertain.append (key)
+
+    if uncertain:
+        listFile = listBase + '_remoteTouched'
+        with open(listFile, 'w') as of:
+            for key in uncertain:
+                of.write('/' + key + '\n')
+        try:
+            listed, = listTrees ((remoteName, filterSwitches + ['--files-from', listFile]))
+        except IOError as e:
+            logging.warning (printMsg ("REMOTE", "  Uploaded file lookup failed", e))
+            return None
+        finally:
+            os.remove(listFile)
+        for key in uncertain:
+            if key not in listed:
+                logging.warning (printMsg ("REMOTE", "  Uploaded file not found", key))
+                return None
+            newRemote[key] = listed[key]
+    return newRemote
+
+
+def writeList (outfile, d):
+    # Write a listing in rclone lsl text format, sorted by path.  Used by --ExportLists.
+    with open(outfile, 'w') as of:
+        for key in sorted(d):
+            of.write("{:9d} {} {}\n".format(d[key]['size'], lslTime(d[key]['datetime']), key))
 
 
 
@@ -338,49 +732,2466 @@ def printMsg (locale, msg, key=''):
     return "{:9}{:35} - {}".format(locale, msg, key)
 
 
-lineFormat = re.compile('\s*([0-9]+) ([\d\-]+) ([\d:]+).([\d]+) (.*)')
+# ***** Delta engine *****
+# Each tree's changes are found on their own.  Prior and Now both in memory are compared with dict lookups, as the
+# original loops did, and only the changed paths are sorted.  Where either is a snapshot the two listings are merged
+# in sorted path order, so the snapshot is read in one sequential scan and never looked up by path.  Either way an
+# entry with the same size and modtime (and no hash) is passed over without a deltaFlags call.  Each changed path
+# gets a small int of delta flags.
+
+deltaNew     = 1
+deltaNewer   = 2
+deltaOlder   = 4
+deltaSize    = 8
+deltaDeleted = 16
+deltaHash    = 32               # Same size and modtime, but the content hash is different
+
+deltaMessages = ((deltaDeleted, "  File was deleted"), (deltaNew, "  File is new"), (deltaNewer, "  File is newer"),
+                 (deltaOlder, "  File is OLDER"), (deltaSize, "  File size is different"),
+                 (deltaHash, "  File content is different"))
+
+
+class ChangeSet (object):
+    # Changed paths of one tree, in sorted order, each mapped to its delta flags
+    __slots__ = ('keys', 'flags')
+
+    def __init__ (self):
+        self.keys = []
+        self.flags = {}
+
+    def add (self, key, flags):                     # Keys must be added in sorted order
+        self.keys.append(key)
+        self.flags[key] = flags
+
+    def __len__ (self):                 return len(self.keys)
+    def __iter__ (self):                return iter(self.keys)
+    def __contains__ (self, key):       return key in self.flags
+    def __getitem__ (self, key):        return self.flags[key]
+
+
+def deltaFlags (prior, now):
+    # Where both entries have a hash of the same type, the hash decides:  a file with only a new modtime is unchanged
+    if prior is None:
+        return deltaNew if now is not None else 0
+    if now is None:
+        return deltaDeleted
+    if prior.hash is not None and now.hash is not None:
+        same = sameContent (prior, now)
+        if same is True:
+            return 0
+        if same is False and prior.datetime == now.datetime and prior.size == now.size:
+            return deltaHash
+    flags = 0
+    if prior.datetime != now.datetime:
+        flags = deltaNewer if prior.datetime < now.datetime else deltaOlder
+    if prior.size != now.size:
+        flags |= deltaSize
+    return flags
+
+
+def sameContent (a, b):
+    # True or False where both entries have a hash of the same type, else None
+    if a is None or b is None or a.hash is None or b.hash is None:
+        return None
+    if a.hash == b.hash:
+        return a.size == b.size
+    if a.hash.split(':', 1)[0] != b.hash.split(':', 1)[0]:
+        return None
+    return False
+
+
+def findDeltas (localPrior, localNow, remotePrior, remoteNow):
+    # Returns the Local and Remote ChangeSets relative to the prior sync
+    return treeDeltas (localPrior, localNow), treeDeltas (remotePrior, remoteNow)
+
+
+def treeDeltas (prior, now):
+    # The ChangeSet of one tree, Now relative to Prior
+    deltas = ChangeSet ()
+    if isinstance(prior, FileList) and isinstance(now, FileList):
+        priorEntries, nowEntries = prior.entries, now.entries
+        changed = {}
+        for key in priorEntries:
+            p = priorEntries[key]
+            n = nowEntries.get(key)
+            if n is None:
+                changed[key] = deltaDeleted
+            elif n.datetime != p.datetime or n.size != p.size or n.hash is not None:
+                flags = deltaFlags (p, n)
+                if flags:
+                    changed[key] = flags
+        if len(nowEntries) > len(priorEntries) - sum(1 for key in changed if changed[key] == deltaDeleted):
+            for key in nowEntries:
+                if key not in priorEntries:
+                    changed[key] = deltaNew
+        for key in sorted(changed):
+            deltas.add (key, changed[key])
+        return deltas
+
+    if isinstance(now, FileList) and isinstance(prior, SnapshotList) and prior.version != 1:
+        # A Prior snapshot against Now in memory, as main() runs it:  a merge of the snapshot's records, read straight
+        # from the file, with Now's sorted paths.  Now's entry is fetched only for a path on both sides.
+        nowEntries = now.entries
+        nowKeys = iter(now)
+        nk = next(nowKeys, None)
+        mm = prior.mm
+        offset = snapshotHeader.size
+        unpack = snapshotRecord.unpack_from
+        recordSize = snapshotRecord.size
+        for _ in range(prior.count):
+            size, datetime, length, hashLength = unpack(mm, offset)
+            start = offset + recordSize
+            end = start + length
+            offset = end + hashLength
+            key = decodePath(mm[start:end])
+            if nk != key:
+                while nk is not None and nk < key:
+                    deltas.add (nk, deltaNew)
+                    nk = next(nowKeys, None)
+                if nk != key:
+                    deltas.add (key, deltaDeleted)
+                    continue
+            n = nowEntries[nk]
+            if n.datetime != datetime or n.size != size or n.hash is not None:
+                flags = deltaFlags (FileEntry (size, datetime, decodeHash(mm[end:offset])), n)
+                if flags:
+                    deltas.add (key, flags)
+            nk = next(nowKeys, None)
+        while nk is not None:
+            deltas.add (nk, deltaNew)
+            nk = next(nowKeys, None)
+        return deltas
+
+    # Otherwise (--StreamBuffer, say) a merge of the two listings' records
+    nowRecords = now.records()
+    end = (None, 0, 0, None)
+    nk, nSize, nTime, nHash = next(nowRecords, end)
+    for key, size, datetime, hash in prior.records():
+        if nk != key:
+            while nk is not None and nk < key:
+                deltas.add (nk, deltaNew)
+                nk, nSize, nTime, nHash = next(nowRecords, end)
+            if nk != key:
+                deltas.add (key, deltaDeleted)
+                continue
+        if nTime != datetime or nSize != size or nHash is not None:
+            flags = deltaFlags (FileEntry (size, datetime, hash), FileEntry (nSize, nTime, nHash))
+            if flags:
+                deltas.add (key, flags)
+        nk, nSize, nTime, nHash = next(nowRecords, end)
+    while nk is not None:
+        deltas.add (nk, deltaNew)
+        nk, nSize, nTime, nHash = next(nowRecords, end)
+    return deltas
+
+
+def logDeltas (locale, deltas):
+    for key in deltas:
+        for flag, msg in deltaMessages:
+            if deltas[key] & flag:
+                logging.info (printMsg (locale, msg, key))
+
+
+# ***** Content hashes *****
+# With --HashType the listings are taken with rclone lsjson, and each entry keeps a content hash of that type (stored
+# in the snapshots).  Where a file has a hash of the same type in both entries being compared, the hash decides
+# whether it changed.  A file with only a new modtime is then unchanged, and a file changed the same way on both
+# sides is not a conflict.  The Remote hashes come with its listing, as most remotes store them.  Local hashes would
+# mean reading every file on every run, so an unchanged Local file (same size and modtime) keeps its hash from the
+# prior listing, and only new or changed files are hashed, by a targeted rclone lsjson --hash.
+
+def hashLocal (localPrior, localNow, listBase):
+    # localNow with its hashes filled in.  A FileList is updated in place.  A snapshot (--StreamBuffer) is rewritten.
+    inPlace = isinstance(localNow, FileList)
+    changed = []
+    for key, (prior, now) in mergeItems (localPrior.items(), localNow.items()):
+        if now is None:
+            continue
+        if prior is not None and prior.hash is not None and prior.size == now.size and prior.datetime == now.datetime:
+            if inPlace:
+                now.hash = prior.hash
+        else:
+            changed.append (key)
+    metrics.count ('hashedLocalFiles', len(changed))
 
-def loadList (infile):
+    hashes = {}
+    if changed:
+        wanted = hashName(hashType)
+        try:
+            for key, found in listHashes (localRoot, changed, listBase + '_localHashes').items():
+                for kind, value in found.items():
+                    if value and hashName(kind) == wanted:
+                        hashes[key] = wanted + ':' + str(value)
+        except (IOError, ValueError, subprocess.CalledProcessError) as e:
+            logging.warning (printMsg ("LOCAL", "Hashing changed files failed", e))
+    if inPlace:
+        for key in changed:
+            localNow[key].hash = hashes.get(key)
+        return localNow
+
+    writer = SnapshotWriter (localNow.path)
+    for key, (prior, now) in mergeItems (localPrior.items(), localNow.items()):
+        if now is None:
+            continue
+        if key in hashes:
+            now.hash = hashes[key]
+        elif prior is not None and prior.hash is not None and prior.size == now.size and prior.datetime == now.datetime:
+            now.hash = prior.hash
+        writer.add (key, now)
+    writer.close()
+    localNow.close()
+    return SnapshotList (localNow.path)
+
+
+def listHashes (path, keys, listFile):
+    # {key: {hash type: hash}} from rclone lsjson --hash of just the given files
+    with open(listFile, 'w') as of:
+        for key in keys:
+            of.write('/' + key + '\n')
+    cmd = ['rclone', 'lsjson', path, '-R', '--files-only', '--hash', '--files-from', listFile]
+    if hashType:
+        cmd += ['--hash-type', hashType]
+    token = metrics.spawned (cmd)
+    try:
+        listing = subprocess.check_output(cmd, universal_newlines=True)
+    finally:
+        metrics.exited (token)
+        os.remove(listFile)
+    return dict((item['Path'], item.get('Hashes') or {}) for item in json.loads(listing))
+
+
+# ***** Move detection *****
+# With --DetectMoves a file that was deleted on one side and turns up new at another path on that same side, with the
+# same size and modtime, is taken as moved.  A folder move shows up as many of these.  Rather than copying the
+# file again from the Remote, or uploading it again with rclone sync, main() repeats the move on the other side
+# with rclone moveto (server-side on the Remote, a rename on Local).  The deleted files are indexed by
+# (size, modtime), so matching takes one pass over the deltas.  The files of a folder move go as one rclone move of
+# the folder, not one rclone moveto each.  --MoveHash also requires the content hashes from
+# rclone lsjson --hash to agree.  A pair is only moved where the other side still has the old path unchanged and
+# doesn't have the new one.  Empty files are left to the normal handling.
+
+def findMoves (deltas, prior, now, otherDeltas, otherNow):
+    # Files moved on one side, as {new key: old key}.  Where several deleted files match a new one, only a single
+    # match with the same file name is taken.
+    deleted = {}
+    for key in deltas:
+        if deltas[key] & deltaDeleted and key not in otherDeltas and key in otherNow:
+            entry = prior[key]
+            if entry.size > 0:
+                deleted.setdefault ((entry.size, entry.datetime), []).append (key)
+    moves = {}
+    if not deleted:
+        return moves
+    for key in deltas:
+        if deltas[key] & deltaNew and key not in otherDeltas and key not in otherNow:
+            entry = now[key]
+            candidates = deleted.get((entry.size, entry.datetime))
+            if not candidates:
+                continue
+            if len(candidates) > 1:
+                name = key.rsplit('/', 1)[-1]
+                candidates = [old for old in candidates if old.rsplit('/', 1)[-1] == name]
+                if len(candidates) != 1:
+                    continue
+            moves[key] = candidates[0]
+            deleted[(entry.size, entry.datetime)].remove (candidates[0])
+    return moves
+
+
+def verifyMoves (moves, movedPath, otherPath, listBase):
+    # --MoveHash:  keep the moves where the new file (on movedPath) and the old one (still on otherPath) have at
+    # least one content hash type in common, and all the common hashes agree.  A pair that a failed hash lookup left
+    # without hashes is dropped on its own, and the others are still checked.
+    newHashes = moveHashes (movedPath, moves.keys(), listBase + '_moveHashes')
+    oldHashes = moveHashes (otherPath, moves.values(), listBase + '_moveHashes')
+    verified = {}
+    for new, old in moves.items():
+        a = newHashes.get(new)
+        b = oldHashes.get(old)
+        if a is None or b is None:
+            logging.warning (printMsg ("", "  No hash from <{}> - Not a move".format(movedPath if a is None else otherPath), new))
+            continue
+        common = [kind for kind in a if a[kind] and b.get(kind)]
+        if not common:
+            logging.info (printMsg ("", "  No hash type in common - Not a move", new))
+        elif all(a[kind] == b[kind] for kind in common):
+            verified[new] = old
+        else:
+            logging.info (printMsg ("", "  Hashes don't match - Not a move", new))
+    return verified
+
+
+def moveHashes (path, keys, listFile):
+    # listHashes for verifyMoves.  If the lookup fails, the hashes of the files rclone lsjson did list (it goes on
+    # past a file it can't read, then exits with an error), or none if its output can't be read.
+    try:
+        return listHashes (path, keys, listFile)
+    except subprocess.CalledProcessError as e:
+        logging.warning (printMsg ("*****", "Hash lookup for moved files returned error {}".format(e.returncode), path))
+        try:
+            return dict((item['Path'], item.get('Hashes') or {}) for item in json.loads(e.output or '[]'))
+        except (ValueError, KeyError, TypeError):
+            return {}
+    except (IOError, ValueError) as e:
+        logging.warning (printMsg ("*****", "Hash lookup for moved files failed", e))
+        return {}
+
+
+def moveFiles (base, pairs, listBase):
+    # Carry out the [(old, new)] moves under base (LocalRoot + '/' or the Remote name).  The files of a folder move,
+    # each keeping its path below the folder (a/b/x -> c/b/x, a/b/y -> c/b/y), go as one rclone move --files-from
+    # of the folder.  A pair on its own gets an rclone moveto.  Returns the pairs moved.
+    groups = {}
+    for old, new in pairs:
+        groups.setdefault (moveFolders (old, new), []).append ((old, new))
+    dryRunSwitches = ['--dry-run'] if dryRun else []
+    moved = []
+    for (src, dest), group in sorted(groups.items(), key=lambda item: item[1][0]):
+        if src is None or len(group) == 1:
+            for old, new in group:
+                if runCommand (['rclone', 'moveto', base + old, base + new] + dryRunSwitches) == 0:
+                    moved.append ((old, new))
+            continue
+        listFile = listBase + '_moves'
+        with open(listFile, 'w') as of:
+            for old, new in group:
+                of.write('/' + old[len(src) + 1:] + '\n')
+        rc = runCommand (['rclone', 'move', base + src, base + dest, '--files-from', listFile] + dryRunSwitches)
+        os.remove(listFile)
+        if rc == 0:
+            moved.extend (group)
+        else:
+            logging.error (printMsg ("*****", "rclone move returned error {}".format(rc), base + src))
+    return moved
+
+
+def moveFolders (old, new):
+    # The folders a file moved between, keeping as much of its path below them as it can:  (src, dest), or
+    # (None, None) if the file name changed.  The two folders must not be one inside the other (rclone won't move
+    # between overlapping paths), and neither can be the root.
+    oldParts = old.split('/')
+    newParts = new.split('/')
+    k = 0
+    while k < min(len(oldParts), len(newParts)) - 1 and oldParts[-1 - k] == newParts[-1 - k]:
+        k += 1
+    for k in range(k, 0, -1):
+        src = '/'.join(oldParts[:-k])
+        dest = '/'.join(newParts[:-k])
+        if not (src + '/').startswith(dest + '/') and not (dest + '/').startswith(src + '/'):
+            return src, dest
+    return None, None
+
+
+# ***** Transfer planning *****
+# Remote to Local copies are gathered by main() and run as one rclone copy per batch rather than one rclone copyto
+# per file.  Conflict copies that need a _REMOTE name are copied as a batch into a staging directory under localWD,
+# then renamed into place.
+
+def copyToLocal (listBase, toLocal, toLocalRemote, remoteNow):
+    toLocal = sorted(set(toLocal))
+    toLocalRemote = sorted(set(toLocalRemote))
+    rc = 0
+
+    if toLocal:
+        rc |= rcloneCopyFrom (remoteName, localRoot, toLocal, listBase + '_toLocal')
+        for key in toLocal:
+            logCopyResult (key, remoteNow[key], logging.info)
+
+    if toLocalRemote:
+        stagingDir = listBase + '_staging'
+        rc |= rcloneCopyFrom (remoteName, stagingDir, toLocalRemote, listBase + '_toLocalRemote')
+        for key in toLocalRemote:
+            dest = localRoot + '/' + key + '_REMOTE'
+            if not dryRun and os.path.exists(stagingDir + '/' + key):
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                shutil.move(stagingDir + '/' + key, dest)
+            logCopyResult (key + '_REMOTE', remoteNow[key], logging.warning)
+        if os.path.exists(stagingDir):
+            shutil.rmtree(stagingDir)
+    return rc
+
+
+def rcloneCopyFrom (src, dest, keys, listFile, switches=[]):
+    # Keys are written with a leading '/' so that names starting with '#' or ';' are not read as comments
+    with open(listFile, 'w') as of:
+        for key in keys:
+            of.write('/' + key + '\n')
+    cmd = ['rclone', 'copy', src, dest, '--files-from', listFile,
+           '--transfers', str(transfers), '--checkers', str(checkers)] + switches
+    if hashType:
+        cmd.append('--checksum')                # A file whose content changed with the same size and modtime
+    if dryRun:
+        cmd.append('--dry-run')
+    rc = runCommand (cmd)
+    os.remove(listFile)
+    if rc != 0:
+        logging.error (printMsg ("*****", "rclone copy returned error {}".format(rc), src))
+    return rc
+
+
+def logCopyResult (path, entry, logFunc):
+    # A batch rclone copy has one rc for all its files, so each is checked against its Remote entry:  a file left
+    # over from before, or cut short, has the wrong size or modtime
+    if dryRun or localMatches (path, entry):
+        logFunc (printMsg ("REMOTE", "  Copying to local", localRoot + '/' + path))
+    else:
+        logging.error (printMsg ("REMOTE", "  Failed copy to local", localRoot + '/' + path))
+
+
+def removeEmptyDirs (remotePath, localPath):
+    for path in (remotePath, localPath):
+        runCommand (['rclone', 'rmdirs', path] + (['--dry-run'] if dryRun else []))
+
+
+# ***** Run journal *****
+# syncTree's plan for a tree goes to <listBase>_journal before the first change is made, together with the Now
+# listings it was made from (as snapshots, <listBase>_journalLocal and _journalRemote).  Each operation is appended
+# as it completes.  The file is fsynced every journalBatch operations or journalInterval seconds, and before each
+# batch transfer:  an operation whose record is lost in a crash is only checked again.  The journal is removed once
+# the new lsl files are written.  A run that finds one (left by a run that died or was killed) resumes that plan
+# rather than listing and diffing again.  Done operations are skipped.  The others are checked against Local as it
+# is now and carried out if it is still as planned.  Paths changed since are left out of the new lsl files, so that
+# the next run sees them as new on both sides and copies rather than deletes.
+
+journalVersion  = 1
+journalBatch    = 200           # Operations per fsync of the journal
+journalInterval = 2.0           # Seconds between fsyncs of the journal
+
+
+class Journal (object):
+    def __init__ (self, listBase):
+        self.path = listBase + '_journal'
+        self.listFiles = (listBase + '_journalLocal', listBase + '_journalRemote')
+        self.f = None
+        self.pending = 0
+        self.synced = 0
+
+    def exists (self):
+        return os.path.exists(self.path)
+
+    def start (self, plan, filterSwitches, localNow, remoteNow):
+        # Write the plan and its Now listings, all fsynced before the first change
+        for listing, listFile in zip((localNow, remoteNow), self.listFiles):
+            if os.path.exists(listFile):
+                os.remove(listFile)
+            if isinstance(listing, SnapshotList):
+                try:
+                    os.link(listing.path, listFile)
+                except OSError:
+                    shutil.copyfile(listing.path, listFile)
+            else:
+                writeSnapshot (listFile, listing)
+            fsyncPath (listFile)
+        record = dict(plan)
+        for name in ('localDeltas', 'remoteDeltas'):    # ChangeSets as [[key, flags]] in sorted order
+            record[name] = [[key, plan[name][key]] for key in plan[name]]
+        header = {'journal': journalVersion, 'started': time.time(), 'remote': remoteName, 'localRoot': localRoot,
+                  'filters': filterSwitches, 'plan': record}
+        with open(self.path + '_tmp', 'w') as of:
+            of.write(json.dumps(header) + '\n')
+            of.flush()
+            os.fsync(of.fileno())
+        os.rename(self.path + '_tmp', self.path)
+        fsyncPath (os.path.dirname(os.path.abspath(self.path)))
+        self.reopen ()
+
+    def reopen (self):
+        self.f = open(self.path, 'a')
+        self.synced = time.time()
+
+    def load (self, filterSwitches):
+        # Returns the header (with the plan) and the set of done operations, or None if the journal is unusable or
+        # is for a different tree
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        try:
+            header = journalStrings (json.loads(lines[0]))
+        except (ValueError, IndexError):
+            logging.warning (printMsg ("*****", "Unreadable run journal", self.path))
+            return None
+        if (header.get('journal') != journalVersion or header.get('remote') != remoteName or
+                header.get('localRoot') != localRoot or header.get('filters') != filterSwitches):
+            logging.warning (printMsg ("*****", "Run journal is for another tree or version", self.path))
+            return None
+        plan = header['plan']
+        for name in ('localDeltas', 'remoteDeltas'):
+            deltas = ChangeSet ()
+            for key, flags in plan[name]:
+                deltas.add (key, flags)
+            plan[name] = deltas
+        done = set()
+        for line in lines[1:]:
+            try:
+                done.add (journalStrings (json.loads(line)['done']))
+            except (ValueError, KeyError):
+                break                           # The record being written when the run died
+        return header, done
+
+    def listings (self):
+        return [SnapshotList (listFile) for listFile in self.listFiles]
+
+    def done (self, op):
+        if self.f is None:
+            return
+        self.f.write(json.dumps({'done': op}) + '\n')
+        self.pending += 1
+        if self.pending >= journalBatch or time.time() - self.synced >= journalInterval:
+            self.sync ()
+
+    def sync (self):
+        if self.f is not None and self.pending:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.pending = 0
+            self.synced = time.time()
+
+    def close (self):
+        # The run failed:  keep the journal for the next run
+        if self.f is not None:
+            self.sync ()
+            self.f.close()
+            self.f = None
+
+    def finish (self):
+        # The run is complete:  remove the journal
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            self.discard ()
+
+    def discard (self):
+        for path in (self.path,) + self.listFiles:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def fsyncPath (path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass                                    # Directories can't be fsynced on some platforms
+    finally:
+        os.close(fd)
+
+
+def journalStrings (value):
+    # json gives unicode strings, where on Python 2 the listings' paths are utf-8 byte strings
+    if str is bytes:
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, list):
+            return [journalStrings (v) for v in value]
+        if isinstance(value, dict):
+            return dict((journalStrings (k), journalStrings (v)) for k, v in value.items())
+    return value
+
+
+def journalPending ():
+    # Whether a run journal (of the whole tree or of any shard) is waiting to be resumed
+    shardsDir = localWD + remoteName[0:-1] + '_shards/'
+    return (os.path.exists(localWD + remoteName[0:-1] + '_journal') or
+            os.path.isdir(shardsDir) and any(name.endswith('_journal') for name in os.listdir(shardsDir)))
+
+
+def resumeTree (label, listBase, filterSwitches, listings, nowFiles):
+    # Finish the run of this tree that left a journal, if any.  Returns syncTree's result, or None to go on with a
+    # normal run.
+    journal = Journal (listBase)
+    if not journal.exists():
+        return None
+    if dryRun:
+        logging.warning (printMsg ("*****", "Unfinished run journal - not resumed by --DryRun", journal.path))
+        return None
+    if firstSync:
+        logging.warning (printMsg ("*****", "Unfinished run journal - discarded for --FirstSync", journal.path))
+        journal.discard ()
+        return None
+    loaded = journal.load (filterSwitches)
+    try:
+        localNow, remoteNow = journal.listings () if loaded is not None else (None, None)
+    except (IOError, ValueError) as e:
+        logging.warning (printMsg ("*****", "Run journal listing unusable", e))
+        loaded = None
+    if loaded is None:
+        logging.warning (printMsg ("*****", "Discarding the run journal - doing a normal run", journal.path))
+        journal.discard ()
+        return None
+
+    header, done = loaded
+    metrics.phase ('resume')
+    metrics.count ('resumed')
+    logging.warning (">>>>> " + label + "Resuming the run started at {} - {} operation(s) already done".format(
+                     time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['started'])), len(done)))
+    if not streamBuffer:
+        snapshots = (localNow, remoteNow)
+        localNow, remoteNow = [FileList (dict(snapshot.items())) for snapshot in snapshots]
+        for snapshot in snapshots:
+            snapshot.close()
+    return applyPlan (label, listBase, filterSwitches, listings, localNow, remoteNow, nowFiles, header['plan'], done)
+
+
+def localMatches (key, entry):
+    # Whether the Local file is as in the listing entry (None:  no such file), by size and modtime to the second
+    try:
+        st = os.stat(localRoot + '/' + key)
+    except OSError:
+        return entry is None
+    return entry is not None and st.st_size == entry['size'] and int(st.st_mtime) == entry['datetime'] // 1000000000
+
+
+def withoutKeys (listing, keys, path):
+    # The listing less the given paths:  a FileList, or for a snapshot a new snapshot written to path
+    if isinstance(listing, SnapshotList):
+        writer = SnapshotWriter (path)
+        for key, entry in listing.items():
+            if key not in keys:
+                writer.add (key, entry)
+        writer.close()
+        listing.close()
+        return SnapshotList (path)
+    return FileList (dict((key, listing[key]) for key in listing if key not in keys))
+
+
+# ***** Targeted push *****
+# With --TargetedPush the Local changes go to the Remote as one rclone copy --files-from of just the changed paths
+# and one rclone delete --files-from of the deleted ones, instead of an rclone sync that checks every object on the
+# Remote.  Only the directories that held removed files are checked for being left empty.  Every
+# --ReconcileEvery'th run (and --FirstSync) is a full rclone sync and rmdirs as before, to catch anything the
+# listings missed.  The count of runs since the last full sync is kept in <remote>_pushRuns.
+
+reconcileRun = True             # This run does the full rclone sync.  Set by main() and daemon().
+
+
+def reconcileDue ():
+    if not targetedPush:
+        return True
+    if not reconcileEvery:
+        return False
+    return readPushRuns () + 1 >= reconcileEvery
+
+
+def readPushRuns ():
+    try:
+        with open(localWD + remoteName[0:-1] + '_pushRuns') as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def writePushRuns (reconciled):
+    stateFile = localWD + remoteName[0:-1] + '_pushRuns'
+    with open(stateFile + '_tmp', 'w') as of:
+        of.write("{}\n".format(0 if reconciled else readPushRuns () + 1))
+    os.rename(stateFile + '_tmp', stateFile)
+
+
+def pushToRemote (listBase, uploads, deletes, filterSwitches):
+    rc = 0
+    uploads = sorted(set(uploads))
+    if uploads:
+        for key in uploads:
+            logging.info (printMsg ("REMOTE", "  Uploading file", key))
+        rc |= rcloneCopyFrom (localRoot, remoteName, uploads, listBase + '_toRemote', filterSwitches)
+    if deletes:
+        listFile = listBase + '_remoteDeletes'
+        with open(listFile, 'w') as of:
+            for key in sorted(deletes):
+                logging.info (printMsg ("REMOTE", "  Deleting file", key))
+                of.write('/' + key + '\n')
+        cmd = ['rclone', 'delete', remoteName, '--files-from', listFile] + filterSwitches
+        if dryRun:
+            cmd.append('--dry-run')
+        deleteRc = runCommand (cmd)
+        os.remove(listFile)
+        if deleteRc != 0:
+            logging.error (printMsg ("*****", "rclone delete returned error {}".format(deleteRc), remoteName))
+        rc |= deleteRc
+    return rc
+
+
+def pruneDirs (removed, listBase, filterSwitches):
+    # Remove the directories left empty by this run's removed files (from either side).  On Local, each file's
+    # directory and then its parents are removed while empty.  The Remote mirrors Local, so the highest directories
+    # that no longer exist on Local are pruned by one rclone rmdirs of the Remote root, with the run's filters and
+    # then a filter that scopes it to those directories.  Any of them already gone from the Remote (moved there, say)
+    # is then just not found by its walk.
+    dirs = set(key.rsplit('/', 1)[0] for key in removed if '/' in key)
+    for d in sorted(dirs, reverse=True):
+        while d:
+            try:
+                os.rmdir(localRoot + '/' + d)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    break
+            d = d.rsplit('/', 1)[0] if '/' in d else ''
+    tops = set()
+    for d in dirs:
+        top = None
+        while d and not os.path.isdir(localRoot + '/' + d):
+            top = d
+            d = d.rsplit('/', 1)[0] if '/' in d else ''
+        if top is not None:
+            tops.add (top)
+    tops = [top for top in sorted(tops) if not any(top.startswith(other + '/') for other in tops)]
+    if not tops:
+        return
+    filterFile = listBase + '_rmdirs'
+    with open(filterFile, 'w') as of:
+        for top in tops:
+            of.write('+ /' + escapeGlob(top) + '/**\n')
+        of.write('- **\n')
+    try:
+        rc = runCommand (['rclone', 'rmdirs', remoteName, '--leave-root'] + filterSwitches + ['--filter-from', filterFile])
+    finally:
+        os.remove(filterFile)
+    if rc != 0:                                     # Only empty directories left behind
+        logging.warning (printMsg ("*****", "rclone rmdirs returned error {}".format(rc), remoteName))
+
+
+# ***** Run metrics *****
+# Each run (and each --Daemon cycle that takes the lock) records the wall time of its phases, every subprocess it
+# spawns (count and wall time per rclone command) and the files and bytes listed, changed and transferred.  Listed
+# counts only full listings;  health checks and targeted listings are counted as checked.  The transfer counts are as planned from the deltas, since rclone sync makes its own choices.  The summary is appended
+# to <remote>_metrics.jsonl in the working directory, one JSON line per run, and with --PromFile also written as a
+# Prometheus textfile collector file.  A phase runs from its metrics.phase() call to the next one on the same thread,
+# so with --Sharded the phase times are summed over the shards and can add up to more than the run's wall time.
+
+class RunMetrics (object):
+    def __init__ (self):
+        self.start = time.time()
+        self.phases = {}                # phase -> seconds
+        self.commands = {}              # 'rclone lsl' etc -> [count, seconds]
+        self.counts = {}                # name -> files or bytes
+        self.lock = threading.Lock()
+        self.current = threading.local()
+
+    def phase (self, name):
+        # End this thread's current phase, if any, and start the named one (None:  just end it)
+        now = time.time()
+        current = getattr(self.current, 'phase', None)
+        if current is not None:
+            with self.lock:
+                self.phases[current[0]] = self.phases.get(current[0], 0.0) + now - current[1]
+        self.current.phase = (name, now) if name is not None else None
+
+    def count (self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def spawned (self, cmd):
+        # Call as a subprocess is started.  Returns the token to pass to exited() once it has been waited for.
+        name = os.path.basename(cmd[0]) + (' ' + cmd[1] if os.path.basename(cmd[0]) == 'rclone' and len(cmd) > 1 else '')
+        return name, time.time()
+
+    def exited (self, token):
+        name, start = token
+        with self.lock:
+            command = self.commands.setdefault(name, [0, 0.0])
+            command[0] += 1
+            command[1] += time.time() - start
+
+    def summary (self, rc):
+        with self.lock:
+            return {'remote': remoteName[0:-1], 'start': round(self.start, 3), 'seconds': round(time.time() - self.start, 3),
+                    'rc': rc, 'dryRun': dryRun, 'firstSync': firstSync,
+                    'phases': dict((name, round(seconds, 3)) for name, seconds in self.phases.items()),
+                    'subprocesses': sum(count for count, seconds in self.commands.values()),
+                    'commands': dict((name, {'count': count, 'seconds': round(seconds, 3)})
+                                     for name, (count, seconds) in self.commands.items()),
+                    'counts': dict(self.counts)}
+
+metrics = RunMetrics ()
+
+
+def runCommand (cmd):
+    # subprocess.call, counted and timed in the run metrics
+    token = metrics.spawned (cmd)
+    try:
+        return subprocess.call(cmd)
+    finally:
+        metrics.exited (token)
+
+
+def countTransfers (keys, listing, name):
+    # Count the files, and their bytes from the listing, as transferred
+    keys = set(keys)
+    metrics.count (name + 'Files', len(keys))
+    metrics.count (name + 'Bytes', sum(listing[key].size for key in keys if key in listing))
+
+
+def writeMetrics (rc):
+    # Append the run summary to <remote>_metrics.jsonl, and write the --PromFile.  A failure here doesn't fail the run.
+    metrics.phase (None)
+    summary = metrics.summary (rc)
+    logging.info (printMsg ("", "Run metrics", "{seconds:.1f}s, {subprocesses} subprocesses".format(**summary)))
+    try:
+        with open(localWD + remoteName[0:-1] + '_metrics.jsonl', 'a') as of:
+            of.write(json.dumps(summary, sort_keys=True) + '\n')
+        if promFile:
+            with open(promFile + '_tmp', 'w') as of:
+                for line in promLines (summary):
+                    of.write(line + '\n')
+            os.rename(promFile + '_tmp', promFile)
+    except (IOError, OSError) as e:
+        logging.warning (printMsg ("*****", "Could not write run metrics", e))
+
+
+def promLines (summary):
+    # The summary in the Prometheus text exposition format
+    def label (value):
+        return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    remote = 'remote=' + label(summary['remote'])
+    yield '# HELP rclonesync_last_run_timestamp_seconds Start time of the last run.'
+    yield '# TYPE rclonesync_last_run_timestamp_seconds gauge'
+    yield 'rclonesync_last_run_timestamp_seconds{{{}}} {}'.format(remote, summary['start'])
+    yield '# HELP rclonesync_run_seconds Wall time of the last run.'
+    yield '# TYPE rclonesync_run_seconds gauge'
+    yield 'rclonesync_run_seconds{{{}}} {}'.format(remote, summary['seconds'])
+    yield '# HELP rclonesync_run_success 1 if the last run succeeded, else 0.'
+    yield '# TYPE rclonesync_run_success gauge'
+    yield 'rclonesync_run_success{{{}}} {}'.format(remote, 1 if summary['rc'] == 0 else 0)
+    yield '# HELP rclonesync_phase_seconds Wall time of each phase of the last run, summed over shards.'
+    yield '# TYPE rclonesync_phase_seconds gauge'
+    for name in sorted(summary['phases']):
+        yield 'rclonesync_phase_seconds{{{},phase={}}} {}'.format(remote, label(name), summary['phases'][name])
+    yield '# HELP rclonesync_subprocesses Subprocesses spawned by the last run, by command.'
+    yield '# TYPE rclonesync_subprocesses gauge'
+    for name in sorted(summary['commands']):
+        yield 'rclonesync_subprocesses{{{},command={}}} {}'.format(remote, label(name), summary['commands'][name]['count'])
+    yield '# HELP rclonesync_subprocess_seconds Wall time of the subprocesses of the last run, by command.'
+    yield '# TYPE rclonesync_subprocess_seconds gauge'
+    for name in sorted(summary['commands']):
+        yield 'rclonesync_subprocess_seconds{{{},command={}}} {}'.format(remote, label(name), summary['commands'][name]['seconds'])
+    for name in sorted(summary['counts']):
+        metric = 'rclonesync_' + ''.join('_' + c.lower() if c.isupper() else c for c in name)
+        yield '# TYPE {} gauge'.format(metric)
+        yield '{}{{{}}} {}'.format(metric, remote, summary['counts'][name])
+
+
+# ***** Quick check *****
+# With --QuickCheck N a run first looks for any sign of change since the last full run, and skips the health check,
+# listings and sync if there is none.  Local:  a walk of LocalRoot for a directory modtime (entries added, deleted or
+# renamed) or file ctime (content or name changed) past the cutoff.  Remote:  an rclone lsl --max-age, stopped at
+# the first file.  A remote delete or rename with no other change doesn't show there, nor does a file uploaded with
+# an old modtime kept (as rclone copy and most sync clients do), so after N skipped runs in a row a full run is done
+# regardless.  The cutoff is the start of the last full run, less quickCheckSlack for clock
+# differences, so that run's own copies and uploads trigger one more full run.
+# The state (<remote>_quickCheck) holds the last full run's start time and duration, and the skipped run count.
+
+quickCheckSlack = 120
+
+
+def quickCheck (excludeSwitches):
+    state = readQuickState ()
+    if state is None:
+        logging.info (printMsg ("", "Quick check", "No prior run recorded - Full run"))
+        return False
+    since, duration, skipped = state
+    if skipped >= quickCheckRuns:
+        logging.info (printMsg ("", "Quick check", "{} runs skipped - Full run due".format(skipped)))
+        return False
+
+    start = time.time()
+    cutoff = since - quickCheckSlack
+    changed = localChangedSince (cutoff)
+    if changed:
+        logging.info (printMsg ("LOCAL", "Quick check found a change", changed))
+        return False
+    changed = remoteChangedSince (cutoff, excludeSwitches)
+    if changed:
+        logging.info (printMsg ("REMOTE", "Quick check found a change", changed))
+        return False
+
+    elapsed = time.time() - start
+    if not dryRun:
+        writeQuickState (since, duration, skipped + 1)
+    logging.warning (printMsg ("", "Quick check found no changes", "Skipped run {} of {}, check took {:.1f}s, saved about {:.1f}s"
+                               .format(skipped + 1, quickCheckRuns, elapsed, max(0, duration - elapsed))))
+    return True
+
+
+def localChangedSince (cutoff):
+    # The first path under LocalRoot changed at or after cutoff, or None
+    if not os.path.isdir(localRoot):
+        return localRoot
+    for dirpath, dirnames, filenames in os.walk(localRoot):
+        if os.lstat(dirpath).st_mtime >= cutoff:
+            return dirpath
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                if os.lstat(path).st_ctime >= cutoff:
+                    return path
+            except OSError:                     # Deleted during the walk
+                return path
+    return None
+
+
+def remoteChangedSince (cutoff, excludeSwitches):
+    # The first Remote file modified at or after cutoff, or None.  A failed listing counts as a change.
+    cmd = ['rclone', 'lsl', remoteName, '--max-age', '{}s'.format(int(time.time() - cutoff) + 1)] + excludeSwitches
+    token = metrics.spawned (cmd)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    line = proc.stdout.readline()
+    if line:
+        proc.terminate()
+    proc.stdout.close()
+    rc = proc.wait()
+    metrics.exited (token)
+    if line:
+        return line.strip().split(' ', 3)[-1]
+    if rc != 0:
+        return "rclone lsl returned {}".format(rc)
+    return None
+
+
+def readQuickState ():
+    try:
+        with open(localWD + remoteName[0:-1] + '_quickCheck') as f:
+            since, duration, skipped = f.read().split()
+        return float(since), float(duration), int(skipped)
+    except (IOError, ValueError):
+        return None
+
+
+def writeQuickState (since, duration, skipped):
+    stateFile = localWD + remoteName[0:-1] + '_quickCheck'
+    with open(stateFile + '_tmp', 'w') as of:
+        of.write("{:.3f} {:.3f} {}\n".format(since, duration, skipped))
+    os.rename(stateFile + '_tmp', stateFile)
+
+
+# ***** Daemon mode *****
+# --Daemon stays running and syncs in cycles, every --DaemonInterval seconds.  The prior listings stay in memory
+# between cycles.  LocalRoot is watched with inotify, or polled with a walk of the tree where inotify is not
+# available, and a cycle re-lists only the Local paths seen to change.  It does that with a targeted rclone lsl
+# --files-from, so that exclusions and modtimes come out exactly as in a full listing.  The Remote is re-listed in
+# full, after a full health check, every --RemoteInterval seconds.  Between those, each cycle checks that the local
+# RCLONE_TEST files are still in place, and its Remote view is the last Remote listing.  Since a file added to the
+# Remote after that listing would look deleted there (and an edit look unchanged), a cycle between Remote listings
+# never runs rclone sync:  it pushes just the changed paths, as --TargetedPush does.  Before that it checks the
+# Remote with an rclone lsl --max-age of the files modified since the last Remote listing and an rclone lsl
+# --files-from of the paths about to be pushed.  If either finds a file not as in the last Remote listing, the
+# cycle is made a Remote cycle instead.  A Remote change that neither finds (a delete, or an upload that kept an old
+# modtime, of a path not being pushed) is left alone and picked up at the next Remote listing.  A cycle with work to do takes the lock file and writes the prior
+# snapshots, as a single run does.  A failed cycle drops the in-memory listings, and the next cycle starts again
+# from the snapshots with full listings.
+
+def daemon ():
+    global firstSync, metrics, reconcileRun
+    excludeSwitches = getExcludeSwitches ()
+    if excludeSwitches is None:
+        return 1
+    if sharded or streamBuffer:
+        logging.error (printMsg ("*****", "--Daemon does not support --Sharded or --StreamBuffer", ""))
+        return 1
+
+    stop = []
+    def onSignal (signum, frame):
+        stop.append (signum)
+    signal.signal (signal.SIGTERM, onSignal)
+
+    watcher = startWatcher ()
+    listBase = localWD + remoteName[0:-1]
+    listings = None                 # None:  next cycle starts from the snapshots with full listings
+    checkKeys = None
+    remoteDue = 0
+    remoteListed = None             # Start of the last Remote cycle
+    nextCycle = time.time()
+    logging.warning (printMsg ("", "Daemon started", "{}, every {}s, Remote every {}s"
+                               .format(type(watcher).__name__, daemonInterval, remoteInterval)))
+
+    while not stop:
+        try:
+            while not stop and time.time() < nextCycle:
+                watcher.wait (min(1.0, nextCycle - time.time()))
+            if stop:
+                break
+            nextCycle = time.time() + daemonInterval
+            cycleStart = time.time()
+            remoteCycle = listings is None or cycleStart >= remoteDue
+            if not remoteCycle and not watcher.pending():
+                continue
+        except OSError as e:
+            logging.warning (printMsg ("", "Watcher failed - polling instead", e))
+            watcher.close()
+            watcher = PollWatcher (localRoot)
+            listings = None
+            continue
+
+        if requestLock (sys.argv) != 0:
+            logging.warning ("Prior lock file in place.  Skipping this cycle.")
+            continue
+        metrics = RunMetrics ()
+        rc = 1
+        try:
+            try:
+                dirty, rescan = watcher.take()
+            except OSError as e:                # Re-watching a new directory can fail as well
+                logging.warning (printMsg ("", "Watcher failed - polling instead", e))
+                watcher.close()
+                watcher = PollWatcher (localRoot)
+                dirty, rescan = [], True
+                listings = None                 # Both sides listed in full this cycle
+                remoteCycle = True
+            if not remoteCycle:
+                changed = None
+                if rescan or listings.localPrior is None:
+                    changed = "Local re-list"
+                else:
+                    try:
+                        metrics.phase ('refreshLocal')
+                        listings.localNow = refreshLocal (listings.localPrior, dirty, excludeSwitches, listBase)
+                        metrics.phase ('remoteCheck')
+                        changed = remoteChangedSinceListed (listings, remoteListed, excludeSwitches, listBase)
+                    except IOError as e:
+                        listings.localNow = None
+                        changed = str(e)
+                if changed:
+                    logging.info (printMsg ("REMOTE", "Not as last listed - Remote re-list", changed))
+                    remoteCycle = True
+            reconcileRun = reconcileDue () if remoteCycle else False     # Only push between Remote listings
+            logging.info (">>>>> Daemon cycle:  {} Local path(s) changed{}{}".format(len(dirty),
+                          ", Local re-list" if rescan or listings is None else "", ", Remote re-list" if remoteCycle else ""))
+            rc = 0
+            metrics.phase ('healthCheck')
+            if remoteCycle:
+                checkKeys = healthCheck ()
+                if checkKeys is None:
+                    rc = 1
+            else:
+                for key in checkKeys:
+                    if not os.path.exists(localRoot + '/' + key):
+                        logging.error (printMsg ("*****", "Failed access health test:  Local check file missing", key))
+                        rc = 1
+            if rc == 0 and listings is None:
+                metrics.phase ('relayout')
+                base = unshardPriors ()
+                if base is None:
+                    rc = 1
+                else:
+                    listBase = base
+                listings = TreeListings ()
+            if rc == 0:
+                try:
+                    if rescan or listings.localPrior is None:
+                        listings.localNow = None
+                    elif listings.localNow is None:
+                        metrics.phase ('refreshLocal')
+                        listings.localNow = refreshLocal (listings.localPrior, dirty, excludeSwitches, listBase)
+                    listings.remoteNow = None if remoteCycle else listings.remotePrior
+                    rc, synced = syncTree ('', listBase, excludeSwitches, listings)
+                    if synced:
+                        metrics.phase ('rmdirs')
+                        removeEmptyDirs (remoteName, localRoot)
+                except IOError as e:
+                    logging.error (printMsg ("*****", "Local re-list failed", e))
+                    rc = 1
+            if rc == 0:
+                listings.localNow = listings.remoteNow = None
+                if targetedPush and not dryRun:
+                    writePushRuns (reconcileRun or firstSync)
+                firstSync = False
+                if remoteCycle:
+                    remoteDue = cycleStart + remoteInterval
+                    remoteListed = cycleStart
+            else:
+                logging.error ("***** Cycle failed.  Next cycle starts over from the lsl files. *****")
+                listings = None
+        finally:
+            writeMetrics (rc)
+            releaseLock (sys.argv)
+
+    watcher.close()
+    logging.warning (printMsg ("", "Daemon stopped", ""))
+    return 0
+
+
+def refreshLocal (prior, dirty, excludeSwitches, listBase):
+    # The Local listing:  the prior listing with the changed paths re-listed.  A changed directory stands for
+    # everything under it, both what is there now and what the prior listing had there.
+    entries = dict(prior.entries)
+    paths = set()
+    prefixes = []
+    for rel in dirty:
+        full = localRoot + '/' + rel
+        if os.path.isdir(full) and not os.path.islink(full):
+            for dirpath, dirnames, filenames in os.walk(full):
+                relDir = rel + dirpath[len(full):].replace(os.sep, '/')
+                paths.update (relDir + '/' + name for name in filenames)
+        else:
+            paths.add (rel)
+        if not os.path.isfile(full):
+            prefixes.append (rel + '/')
+    if prefixes:
+        prefixes = tuple(prefixes)
+        paths.update (key for key in entries if key.startswith(prefixes))
+    if not paths:
+        return FileList (entries)
+
+    listFile = listBase + '_localChanged'
+    with open(listFile, 'w') as of:
+        for key in paths:
+            of.write('/' + key + '\n')
+    try:
+        listed, = listTrees ((localRoot, excludeSwitches + ['--files-from', listFile]))
+    finally:
+        os.remove(listFile)
+    for key in paths:
+        if key in listed:
+            entries[key] = listed[key]
+        else:
+            entries.pop(key, None)
+    return FileList (entries)
+
+
+def remoteChangedSinceListed (listings, since, excludeSwitches, listBase):
+    # For a cycle between Remote listings:  the first Remote path found not as in listings.remotePrior, or None.
+    # Checked are the files modified since the last Remote listing (less quickCheckSlack for clock differences)
+    # and the paths that differ between localPrior and localNow, which this cycle would push.
+    prior = listings.remotePrior
+    localDeltas, remoteDeltas = findDeltas (listings.localPrior, listings.localNow, prior, prior)
+    jobs = [(remoteName, excludeSwitches + ['--max-age', '{}s'.format(int(time.time() - since + quickCheckSlack) + 1)])]
+    listFile = listBase + '_remoteCheck'
+    if localDeltas:
+        with open(listFile, 'w') as of:
+            for key in localDeltas:
+                of.write('/' + key + '\n')
+        jobs.append ((remoteName, excludeSwitches + ['--files-from', listFile]))
+    try:
+        listed = listTrees (*jobs)
+    finally:
+        if localDeltas:
+            os.remove(listFile)
+    for key, entry in listed[0].items():
+        if deltaFlags (prior[key] if key in prior else None, entry):
+            return key
+    if localDeltas:
+        for key in localDeltas:
+            if deltaFlags (prior[key] if key in prior else None, listed[1][key] if key in listed[1] else None):
+                return key
+    return None
+
+
+def startWatcher ():
+    try:
+        return InotifyWatcher (localRoot)
+    except (ImportError, AttributeError, OSError) as e:
+        logging.warning (printMsg ("", "inotify not available - polling instead", e))
+        return PollWatcher (localRoot)
+
+
+def fsEncode (path):
+    if hasattr(os, 'fsencode'):
+        return os.fsencode(path)
+    return path if isinstance(path, bytes) else path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+def fsDecode (name):
+    return os.fsdecode(name) if hasattr(os, 'fsdecode') else name
+
+
+class InotifyWatcher (object):
+    # Linux inotify, through ctypes, on every directory under root.  Gathers the paths, relative to root, of files
+    # and directories created, changed, deleted or moved.  rescan is set if the kernel queue overflowed.
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_DONT_FOLLOW, IN_ISDIR = 0x4000, 0x8000, 0x1000000, 0x2000000, 0x40000000
+    IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+    event = struct.Struct('iIII')
+
+    def __init__ (self, root):
+        import ctypes, ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO |
+                     self.IN_CREATE | self.IN_DELETE | self.IN_ONLYDIR | self.IN_DONT_FOLLOW)
+        self.paths = {}                             # watch descriptor -> directory relative to root
+        self.dirty = set()
+        self.rescan = False
+        try:
+            self.watchTree ('')
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def watchTree (self, rel):
+        top = self.root + ('/' + rel if rel else '')
+        for dirpath, dirnames, filenames in os.walk(top):
+            wd = self.libc.inotify_add_watch(self.fd, fsEncode(dirpath), self.mask)
+            if wd < 0:
+                err = self.ctypes.get_errno()
+                if err == errno.ENOENT and dirpath != top:      # Gone already.  The dirty path covers it.
+                    continue
+                raise OSError(err, "inotify_add_watch failed (fs.inotify.max_user_watches?)", dirpath)
+            self.paths[wd] = (rel + dirpath[len(top):].replace(os.sep, '/')).strip('/')
+
+    def unwatchTree (self, rel):
+        for wd, path in list(self.paths.items()):
+            if path == rel or path.startswith(rel + '/'):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def read (self):
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:         # No more events
+                    return
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.event.unpack_from(data, offset)
+                name = data[offset + self.event.size:offset + self.event.size + length].rstrip(b'\0')
+                offset += self.event.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.rescan = True
+                    continue
+                parent = self.paths.get(wd)
+                if parent is None:
+                    continue
+                if mask & self.IN_IGNORED:          # Directory deleted
+                    del self.paths[wd]
+                    continue
+                if not name:
+                    continue
+                rel = (parent + '/' if parent else '') + fsDecode(name)
+                self.dirty.add (rel)
+                if mask & self.IN_ISDIR:
+                    if mask & self.IN_MOVED_FROM:
+                        self.unwatchTree (rel)
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self.watchTree (rel)
+
+    def wait (self, timeout):
+        select.select([self.fd], [], [], max(0, timeout))
+        self.read()
+
+    def pending (self):
+        self.read()
+        return self.rescan or len(self.dirty) > 0
+
+    def take (self):
+        self.read()
+        changes = self.dirty, self.rescan
+        self.dirty = set()
+        self.rescan = False
+        return changes
+
+    def close (self):
+        os.close(self.fd)
+
+
+class PollWatcher (object):
+    # Fallback for InotifyWatcher:  walks the tree once a cycle and compares each file's size, modtime and ctime with
+    # the walk before.
+    def __init__ (self, root):
+        self.root = root
+        self.dirty = set()
+        self.rescan = False
+        self.files = self.walk()
+
+    def walk (self):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            relDir = dirpath[len(self.root):].replace(os.sep, '/').strip('/')
+            for name in filenames:
+                try:
+                    st = os.lstat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files[relDir + '/' + name if relDir else name] = (st.st_size, st.st_mtime, st.st_ctime)
+        return files
+
+    def wait (self, timeout):
+        time.sleep(max(0, timeout))
+
+    def pending (self):
+        files = self.walk()
+        for rel in files:
+            if self.files.get(rel) != files[rel]:
+                self.dirty.add (rel)
+        for rel in self.files:
+            if rel not in files:
+                self.dirty.add (rel)
+        self.files = files
+        return len(self.dirty) > 0
+
+    def take (self):
+        changes = self.dirty, self.rescan
+        self.dirty = set()
+        return changes
+
+    def close (self):
+        pass
+
+
+# ***** Sharded sync *****
+# With --Sharded the tree is split into shards:  each top-level directory (or each --ShardDirs path), plus a root
+# shard holding everything else.  Each shard is listed, diffed and synced on its own by a pool of --ShardWorkers
+# threads, with its own prior sync listings in <remote>_shards/ under the working directory.  A shard is scoped by an
+# rclone filter file, so paths stay relative to LocalRoot and the exclusions apply as they do to the whole tree.
+# Peak memory follows the shards being worked on, not the whole tree.  The health check and lock stay global.
+# When the set of shards changes the prior listings are re-split to match (relayoutPriors).
+
+def syncShards ():
+    metrics.phase ('relayout')
+    if shardDirs:
+        shards = sorted(set(d.strip('/') for d in shardDirs.split(',') if d.strip('/')))
+        for a in shards:
+            for b in shards:
+                if b.startswith(a + '/'):
+                    logging.error (printMsg ("*****", "Overlapping --ShardDirs", a + ', ' + b))
+                    return 1
+    else:
+        try:
+            shards = discoverShards ()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.error (printMsg ("*****", "Specified --LocalRoot or --Cloud invalid?", e))
+            return 1
+
+    try:
+        if firstSync:
+            wholeBase = localWD + remoteName[0:-1] + ('DRYRUN' if dryRun else '')    # A dry run lays out its own copy
+            if os.path.isdir(wholeBase + '_shards/'):
+                shutil.rmtree(wholeBase + '_shards/')
+            os.makedirs(wholeBase + '_shards/')
+            writeLayout (wholeBase + '_shards/', shards)
+        else:
+            wholeBase = relayoutPriors (shards)
+    except (IOError, ValueError) as e:
+        logging.error (printMsg ("*****", "Prior sync listing unusable - Run with --FirstSync", e))
+        return 1
+    shardsDir = wholeBase + '_shards/'
+    logging.info (printMsg ("", "Sharded sync", "{} shards, {} workers".format(len(shards) + 1, shardWorkers)))
+
+    excludeLines = []
+    if exclusions:
+        with open(exclusions) as f:
+            excludeLines = [line.rstrip('\r\n') for line in f if line.strip() and line.lstrip()[0] not in '#;']
+
+    def job (shard):
+        listBase = shardsDir + shardFile(shard)
+        filterFile = listBase + '_filter'
+        with open(filterFile, 'w') as of:
+            for line in shardFilter (shard, shards, excludeLines):
+                of.write(line + '\n')
+        try:
+            rc, synced = syncTree ('[' + (shard or '/') + '] ', listBase, ['--filter-from', filterFile])
+        finally:
+            os.remove(filterFile)
+        if synced and shard is not None:
+            metrics.phase ('rmdirs')
+            removeEmptyDirs (remoteName + shard, localRoot + '/' + shard)
+        metrics.phase (None)
+        return rc, synced
+
+    metrics.phase (None)
+    results = runPool ([lambda shard=shard: job(shard) for shard in [None] + shards], shardWorkers)
+    rc = 0
+    for shard, result in zip([None] + shards, results):
+        if result is None or result[0]:
+            logging.error (printMsg ("*****", "Shard failed", shard or '/'))
+            rc = 1
+    if results[0] is not None and results[0][1] and shardDirs:
+        metrics.phase ('rmdirs')
+        removeEmptyDirs (remoteName, localRoot)         # The root shard holds the directories outside --ShardDirs
+    return rc
+
+
+def discoverShards ():
+    # Top-level directories on either side
+    shards = set()
+    for name in os.listdir(localRoot):
+        path = os.path.join(localRoot, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shards.add(name)
+    cmd = ['rclone', 'lsd', remoteName]
+    token = metrics.spawned (cmd)
+    try:
+        listing = subprocess.check_output(cmd, universal_newlines=True)
+    finally:
+        metrics.exited (token)
+    for line in listing.splitlines():
+        fields = line.split(None, 4)            # -1 2017-08-06 21:25:14 -1 name
+        if len(fields) == 5:
+            shards.add(fields[4])
+    return sorted(shards)
+
+
+def shardFile (shard):
+    # File name part for a shard.  All but letters, digits, '.' and '-' are %-escaped, so '_root' can't clash.
+    if shard is None:
+        return '_root'
+    return ''.join(c if c.isalnum() or c in '.-' else '%{:02X}'.format(ord(c)) for c in shard)
+
+
+def shardFilter (shard, shards, excludeLines):
+    # rclone filter rules for a shard:  the exclusions first, then the shard's own scope
+    rules = ['- ' + line for line in excludeLines]
+    if shard is not None:
+        rules += ['+ /' + escapeGlob(shard) + '/**', '- **']
+    else:
+        rules += ['- /' + escapeGlob(d) + '/**' for d in shards] + ['+ **']
+    return rules
+
+
+def escapeGlob (path):
+    return ''.join('\\' + c if c in '\\*?[]{}' else c for c in path)
+
+
+def shardOf (key, shards):
+    # The shard holding a path:  its longest leading directory path in shards, else None for the root shard
+    found = None
+    i = key.find('/')
+    while i != -1:
+        if key[:i] in shards:
+            found = key[:i]
+        i = key.find('/', i + 1)
+    return found
+
+
+def readLayout (shardsDir):
+    with open(shardsDir + '_layout', 'rb') as f:
+        return [decodePath(line.rstrip(b'\n')) for line in f if line.rstrip(b'\n')]
+
+
+def writeLayout (shardsDir, shards):
+    with open(shardsDir + '_layout_tmp', 'wb') as of:
+        for shard in shards:
+            of.write(encodePath(shard) + b'\n')
+    os.rename(shardsDir + '_layout_tmp', shardsDir + '_layout')
+
+
+def relayoutPriors (shards):
+    # Re-split the prior sync listings if they were written for another set of shards (shards is None for an
+    # unsharded run).  The old listings are merged in path order and each entry routed to its new shard.  A dir
+    # shard covers one contiguous range of paths, so only it and the root shard are being written at any time.
+    # The new listings are built in <remote>_shards.new/ and swapped in, so an interrupted run leaves the old ones.
+    # A --DryRun leaves the real listings as they are and re-splits them into <remote>DRYRUN_shards/ or
+    # <remote>DRYRUN_*LSL instead.  Returns the base of the listings to sync against:  <remote> or <remote>DRYRUN.
+    wholeBase = localWD + remoteName[0:-1]
+    shardsDir = wholeBase + '_shards/'
+    newDir = wholeBase + '_shards.new/'
+    if os.path.isdir(newDir) and not dryRun:
+        if not os.path.isdir(shardsDir) and os.path.exists(newDir + '_layout'):
+            os.rename(newDir, shardsDir)                # Interrupted after the old layout was removed
+        else:
+            shutil.rmtree(newDir)
+
+    if os.path.isdir(shardsDir):
+        oldShards = readLayout (shardsDir)
+        if shards is not None and oldShards == shards:
+            return wholeBase
+        oldBases = [shardsDir + shardFile(shard) for shard in [None] + oldShards]
+    else:
+        if shards is None or not os.path.exists(wholeBase + '_localLSL'):
+            return wholeBase                            # Unsharded last time too, or nothing to re-split
+        oldBases = [wholeBase]
+
+    if journalPending () and not dryRun:                # Planned against the old layout
+        logging.warning (printMsg ("*****", "Unfinished run journal discarded - the shards have changed", ""))
+        Journal (wholeBase).discard ()
+    logging.warning (printMsg ("", "Re-splitting prior sync listings", "{} -> {} shards".format(
+        len(oldBases), 1 if shards is None else len(shards) + 1)))
+    outBase = wholeBase + 'DRYRUN' if dryRun else wholeBase
+    if dryRun:
+        newDir = outBase + '_shards/'
+        if os.path.isdir(newDir):
+            shutil.rmtree(newDir)
+    if shards is not None:
+        os.makedirs(newDir)
+        newBase = lambda shard: newDir + shardFile(shard)
+    else:
+        newBase = lambda shard: outBase
+    shardSet = set(shards or [])
+
+    for suffix in ('_localLSL', '_remoteLSL'):
+        sources = [loadPrior (base + suffix) for base in oldBases]
+        try:
+            root = SnapshotWriter (newBase(None) + suffix)
+            writers = {}
+            current = None
+            for key, entry in heapq.merge(*[source.items() for source in sources]):
+                shard = shardOf (key, shardSet)
+                if shard is None:
+                    root.add (key, entry)
+                    continue
+                if shard != current:
+                    if current is not None:
+                        writers[current].close()
+                    if shard in writers:
+                        raise ValueError("Prior sync listings out of order at " + key)
+                    current = shard
+                    writers[shard] = SnapshotWriter (newBase(shard) + suffix)
+                writers[shard].add (key, entry)
+            if current is not None:
+                writers[current].close()
+            for shard in shardSet - set(writers):
+                SnapshotWriter (newBase(shard) + suffix).close()
+            root.close()
+        finally:
+            for source in sources:
+                source.close()
+
+    if shards is not None:
+        writeLayout (newDir, shards)
+    if dryRun:
+        return outBase
+    if shards is not None:
+        if os.path.isdir(shardsDir):
+            shutil.rmtree(shardsDir)
+        os.rename(newDir, shardsDir)
+        for suffix in ('_localLSL', '_remoteLSL'):
+            if os.path.exists(wholeBase + suffix):
+                os.remove(wholeBase + suffix)
+    else:
+        shutil.rmtree(shardsDir)
+    return wholeBase
+
+
+def runPool (jobs, workers):
+    # Run the callables on up to 'workers' threads.  Returns their results in order, None for one that raised.
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs) - 1, -1, -1))
+    lock = threading.Lock()
+
+    def worker ():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                i = pending.pop()
+            try:
+                results[i] = jobs[i]()
+            except Exception:
+                logging.exception (printMsg ("*****", "Worker failed", ""))
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(jobs))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+    return results
+
+
+try:
+    intern                                  # Python 2 builtin
+except NameError:
+    from sys import intern
+
+
+class FileEntry (object):
+    # One file of a listing.  size in bytes, datetime in nanoseconds since the epoch, hash as '<type>:<hash>' or None
+    # (see --HashType).  Subscriptable so that entry['size'] and entry['datetime'] read the same as the original dict
+    # entries.
+    __slots__ = ('size', 'datetime', 'hash')
+
+    def __init__ (self, size, datetime, hash=None):
+        self.size = size
+        self.datetime = datetime
+        self.hash = hash
+
+    def __getitem__ (self, field):
+        return getattr(self, field)
+
+
+class FileList (object):
+    # Listing of a tree:  path -> FileEntry.  Iterates in sorted path order.  Paths are interned so that the Prior
+    # and Now listings of the same tree share one copy of each path string.
+    __slots__ = ('entries', '_sorted')
+
+    def __init__ (self, entries=None):
+        self.entries = entries if entries is not None else {}
+        self._sorted = None
+
+    def __len__ (self):                 return len(self.entries)
+    def __contains__ (self, key):       return key in self.entries
+    def __getitem__ (self, key):        return self.entries[key]
+    def keys (self):                    return self.entries.keys()
+
+    def __iter__ (self):
+        if self._sorted is None:
+            self._sorted = sorted(self.entries)
+        return iter(self._sorted)
+
+    def items (self):
+        for key in self:
+            yield key, self.entries[key]
+
+    def records (self):                         # (key, size, datetime, hash), in sorted path order
+        entries = self.entries
+        for key in self:
+            entry = entries[key]
+            yield key, entry.size, entry.datetime, entry.hash
+
+    def close (self):
+        pass
+
+
+class TreeListings (object):
+    # Listings of a tree held in memory between runs of syncTree (--Daemon).  None for any that syncTree is to list
+    # or load itself.  syncTree leaves the new prior listings in localPrior and remotePrior.
+    __slots__ = ('localNow', 'remoteNow', 'localPrior', 'remotePrior')
+
+    def __init__ (self, localNow=None, remoteNow=None, localPrior=None, remotePrior=None):
+        self.localNow = localNow
+        self.remoteNow = remoteNow
+        self.localPrior = localPrior
+        self.remotePrior = remotePrior
+
+
+def parseLsl (lines, source):
     # Format ex:
     #  3009805 2013-09-16 04:13:50.000000000 12 - Wait.mp3
     #   541087 2017-06-19 21:23:28.610000000 DSC02478.JPG
     #    size  <----- datetime (epoch) ----> key
+    #
+    # Streams (key, size, datetime) from rclone lsl output.  time.mktime is called twice per distinct date and the
+    # seconds into the day per distinct 'HH:MM:SS', both cached.  On days with a DST change each line uses mktime.
 
+    midnights = {}
+    seconds = {}
+    for line in lines:
+        try:
+            size, date, clock, key = line.lstrip(' ').split(' ', 3)
+            midnight = midnights.get(date)
+            if midnight is None:
+                if len(date) != 10:
+                    raise ValueError
+                ymd = (int(date[0:4]), int(date[5:7]), int(date[8:10]))
+                midnight = int(time.mktime(ymd + (0, 0, 0, 0, 0, -1)))
+                if int(time.mktime(ymd + (23, 59, 59, 0, 0, -1))) - midnight != 86399:
+                    midnight = False                        # DST change on this date
+                midnights[date] = midnight
+            if midnight is False:
+                epoch = int(time.mktime((int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                         int(clock[0:2]), int(clock[3:5]), int(clock[6:8]), 0, 0, -1)))
+            else:
+                hms = clock[:8]
+                secs = seconds.get(hms)
+                if secs is None:
+                    secs = seconds[hms] = int(hms[0:2]) * 3600 + int(hms[3:5]) * 60 + int(hms[6:8])
+                epoch = midnight + secs
+            fraction = clock[9:]
+            nanos = int(fraction) if len(fraction) == 9 else int((fraction + '000000000')[:9])
+            if key.endswith('\n'):
+                key = key[:-1]
+            yield intern(key), int(size), epoch * 1000000000 + nanos, None
+        except ValueError:
+            logging.warning ("Something wrong with this line in {}:\n   <{}>".format(source, line))
+
+
+def parseLsJson (lines, source):
+    # Format ex (rclone lsjson -R --files-only, one object per line):
+    #  {"Path":"a/x.txt","Name":"x.txt","Size":5,"MimeType":"text/plain","ModTime":"2017-08-06T21:25:14.123456789+02:00",
+    #   "IsDir":false,"Hashes":{"md5":"..."}},
+    #
+    # Streams (key, size, datetime, hash) like parseLsl, one line at a time.  The hash is the --HashType one, as
+    # '<type>:<hash>', or None.  ModTime is UTC with an offset, so the conversion is timegm, cached per date.
+    wanted = hashName(hashType) if hashType else None
+    midnights = {}
+    for line in lines:
+        line = line.strip()
+        if line in ('[', ']', ''):
+            continue
+        try:
+            item = json.loads(line[:-1] if line.endswith(',') else line)
+            if item.get('IsDir'):
+                continue
+            key = item['Path']
+            if str is bytes:
+                key = key.encode('utf-8')
+            modTime = item['ModTime']
+            date = modTime[0:10]
+            midnight = midnights.get(date)
+            if midnight is None:
+                midnight = midnights[date] = calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]), 0, 0, 0, 0, 0, 0))
+            epoch = midnight + int(modTime[11:13]) * 3600 + int(modTime[14:16]) * 60 + int(modTime[17:19])
+            zone = modTime[19:]
+            nanos = 0
+            if zone.startswith('.'):
+                end = 1
+                while end < len(zone) and zone[end].isdigit():
+                    end += 1
+                nanos = int((zone[1:end] + '000000000')[:9])
+                zone = zone[end:]
+            if zone not in ('Z', ''):
+                offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+                epoch += -offset if zone[0] == '+' else offset
+            hash = None
+            if wanted:
+                for kind, value in (item.get('Hashes') or {}).items():
+                    if value and hashName(kind) == wanted:
+                        hash = wanted + ':' + str(value)
+            yield intern(key), int(item['Size']), epoch * 1000000000 + nanos, hash
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logging.warning ("Something wrong with this line in {}:\n   <{}>".format(source, line))
+
+
+def hashName (kind):
+    # rclone has named the hash types both 'MD5'/'SHA-1' and 'md5'/'sha1'
+    return str(kind).lower().replace('-', '')
+
+
+def buildList (records):
     d = {}
+    gcWasEnabled = gc.isenabled()
+    gc.disable()                            # The entries hold no cycles.  Don't let GC rescan them as they pile up.
+    try:
+        for key, size, datetime, hash in records:
+            d[key] = FileEntry (size, datetime, hash)
+    finally:
+        if gcWasEnabled:
+            gc.enable()
+    return FileList (d)
+
+
+def loadList (infile):
     with open(infile, 'r') as f:
-        for line in f:
-            out = lineFormat.match(line)
-            if out:
-                size = out.group(1)
-                date = out.group(2)
-                _time = out.group(3)
-                microsec = out.group(4)
-                date_time = time.mktime(datetime.strptime(date + ' ' + _time, '%Y-%m-%d %H:%M:%S').timetuple()) + float('.'+ microsec)
-                filename = out.group(5)
-                d[filename] = {'size': size, 'datetime': date_time}
+        return buildList (parseLsl (f, infile))
+
+
+narrowedSwitches = set(['--include', '--files-from', '--max-age'])      # Not a full listing of the tree
+
+
+def listTrees (*jobs):
+    # Run an rclone lsl (or with --LsJson, rclone lsjson) for each (path, switches) job at the same time, each one's
+    # output streamed straight into the parser on its own thread.  Returns the FileLists in job order.  A job given
+    # as (path, switches, outfile) is sorted into a snapshot at outfile instead (--StreamBuffer), and its result is
+    # the SnapshotList.  If any listing fails the others are stopped and IOError is raised.  The files and bytes of
+    # full listings are counted in the run metrics as listed, those of health checks and targeted listings as checked.
+    procs = []
+    results = [None] * len(jobs)
+    errors = []
+
+    def parse (i, proc, source, outfile, token, side, counter):
+        totals = [0, 0]                     # Files and bytes listed, for the run metrics
+        try:
+            records = parseLsJson (proc.stdout, source) if lsJson else parseLsl (proc.stdout, source)
+            records = countRecords (records, totals)
+            results[i] = sortToSnapshot (records, outfile) if outfile else buildList (records)
+        except Exception as e:
+            errors.append ("<{}> {}".format(source, e))
+        proc.stdout.close()
+        rc = proc.wait()
+        metrics.exited (token)
+        metrics.count (counter + side + 'Files', totals[0])
+        metrics.count (counter + side + 'Bytes', totals[1])
+        if rc != 0:
+            errors.append ("<{}> returned {}".format(source, rc))
+
+    threads = []
+    for i, job in enumerate(jobs):
+        path, switches, outfile = (tuple(job) + (None,))[:3]
+        remote = path.startswith(remoteName)
+        if not lsJson:
+            cmd = ['rclone', 'lsl', path] + switches
+        elif hashType and remote:           # Local hashes would mean reading every file.  See hashLocal.
+            cmd = ['rclone', 'lsjson', path, '-R', '--files-only', '--hash', '--hash-type', hashType] + switches
+        else:
+            cmd = ['rclone', 'lsjson', path, '-R', '--files-only'] + switches
+        token = metrics.spawned (cmd)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        procs.append (proc)
+        side = 'Remote' if remote else 'Local'
+        counter = 'checked' if narrowedSwitches & set(switches) else 'listed'
+        thread = threading.Thread(target=parse, args=(i, proc, ' '.join(cmd), outfile, token, side, counter))
+        thread.daemon = True
+        thread.start()
+        threads.append (thread)
+
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+            if errors:                      # Don't wait out a long listing when the run is going to abort anyway
+                for proc in procs:
+                    if proc.poll() is None:
+                        proc.terminate()
+    if errors:
+        raise IOError('; '.join(errors))
+    return results
+
+
+def countRecords (records, totals):
+    # Pass the parsed records through, adding up the files and bytes in totals
+    for record in records:
+        totals[0] += 1
+        totals[1] += record[1]
+        yield record
+
+
+lslTimeCache = 4096             # Minutes of lsl time text kept by lslTime
+
+
+def lslTime (datetime, _cache={}):
+    # Inverse of the parseLsl time conversion:  nanoseconds since the epoch to lsl local time text.  The text of each
+    # minute is cached, and the cache emptied when full so that a long --Daemon doesn't grow it without bound.
+    secs, nanos = divmod(datetime, 1000000000)
+    minute = _cache.get(secs // 60)
+    if minute is None:
+        if len(_cache) >= lslTimeCache:
+            _cache.clear()
+        minute = _cache[secs // 60] = time.strftime('%Y-%m-%d %H:%M:', time.localtime(secs - secs % 60))
+    return "{}{:02d}.{:09d}".format(minute, secs % 60, nanos)
+
+
+# ***** Prior sync snapshots *****
+# The Local and Remote listings as of the last sync (<remote>_localLSL and <remote>_remoteLSL) are kept in a binary
+# snapshot so that loading them costs next to nothing.  The file is memory-mapped and read in place:
+#   header   magic, format version, flags, record count, index offset, CRC32 of everything after the header
+#   records  sorted by path:  size (int64), datetime (int64 ns), path length (uint16), hash length (uint8),
+#            utf-8 path, ascii '<type>:<hash>' (none if the length is 0)
+#   index    record count x uint64 offsets of the records, for binary search
+# Version 1 snapshots, from before hashes were kept, are read as they are and rewritten as version 2 by the next
+# sync.  An older rclone lsl text file is imported once by loadPrior.  --ExportLists writes the snapshots back out
+# as text.
+
+snapshotMagic   = b'RCSNAP\r\n'
+snapshotVersion = 2
+snapshotHeader  = struct.Struct('<8sHHQQI')
+snapshotRecord  = struct.Struct('<qqHB')
+snapshotRecordV1 = struct.Struct('<qqH')
+snapshotOffset  = struct.Struct('<Q')
+
+
+def encodePath (key):
+    return key if isinstance(key, bytes) else key.encode('utf-8', 'surrogateescape')
+
+def decodePath (raw):
+    return raw if str is bytes else raw.decode('utf-8', 'surrogateescape')
+
+def encodeHash (hash):
+    return b'' if hash is None else hash if isinstance(hash, bytes) else hash.encode('ascii')
+
+def decodeHash (raw):
+    return None if not raw else raw if str is bytes else raw.decode('ascii')
+
+
+class SnapshotList (object):
+    # Read-only listing over a snapshot file, with the same interface as FileList.  Iteration is a sequential scan;
+    # lookups by path are a binary search through the index.
+    __slots__ = ('path', 'mm', 'count', 'indexOffset', 'version')
+
+    def __init__ (self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self.mm) < snapshotHeader.size:
+                raise ValueError("{} is truncated".format(path))
+            magic, self.version, flags, self.count, self.indexOffset, crc = snapshotHeader.unpack_from(self.mm, 0)
+            if magic != snapshotMagic:
+                raise ValueError("{} is not a snapshot file".format(path))
+            if self.version not in (1, snapshotVersion):
+                raise ValueError("{} is snapshot version {}, expected {}".format(path, self.version, snapshotVersion))
+            if self.indexOffset + self.count * snapshotOffset.size != len(self.mm):
+                raise ValueError("{} is truncated".format(path))
+            check = 0
+            for offset in range(snapshotHeader.size, len(self.mm), 1 << 20):
+                check = zlib.crc32(self.mm[offset:offset + (1 << 20)], check)
+            if check & 0xffffffff != crc:
+                raise ValueError("{} failed its checksum".format(path))
+        except ValueError:
+            self.mm.close()
+            raise
+
+    def __len__ (self):
+        return self.count
+
+    def _record (self, offset):
+        if self.version == 1:
+            size, datetime, length = snapshotRecordV1.unpack_from(self.mm, offset)
+            start = offset + snapshotRecordV1.size
+            return decodePath(self.mm[start:start + length]), FileEntry (size, datetime)
+        size, datetime, length, hashLength = snapshotRecord.unpack_from(self.mm, offset)
+        start = offset + snapshotRecord.size
+        end = start + length
+        return decodePath(self.mm[start:end]), FileEntry (size, datetime, decodeHash(self.mm[end:end + hashLength]))
+
+    def _find (self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = snapshotOffset.unpack_from(self.mm, self.indexOffset + mid * snapshotOffset.size)[0]
+            found, entry = self._record(offset)
+            if found == key:
+                return entry
+            if found < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def __contains__ (self, key):
+        return self._find(key) is not None
+
+    def __getitem__ (self, key):
+        entry = self._find(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def items (self):
+        mm = self.mm
+        offset = snapshotHeader.size
+        if self.version == 1:
+            unpack = snapshotRecordV1.unpack_from
+            recordSize = snapshotRecordV1.size
+            for _ in range(self.count):
+                size, datetime, length = unpack(mm, offset)
+                start = offset + recordSize
+                offset = start + length
+                yield decodePath(mm[start:offset]), FileEntry (size, datetime)
+            return
+        unpack = snapshotRecord.unpack_from
+        recordSize = snapshotRecord.size
+        for _ in range(self.count):
+            size, datetime, length, hashLength = unpack(mm, offset)
+            start = offset + recordSize
+            end = start + length
+            offset = end + hashLength
+            yield decodePath(mm[start:end]), FileEntry (size, datetime, decodeHash(mm[end:offset]) if hashLength else None)
+
+    def records (self):
+        # items() without a FileEntry per record:  (key, size, datetime, hash)
+        mm = self.mm
+        offset = snapshotHeader.size
+        if self.version == 1:
+            unpack = snapshotRecordV1.unpack_from
+            recordSize = snapshotRecordV1.size
+            for _ in range(self.count):
+                size, datetime, length = unpack(mm, offset)
+                start = offset + recordSize
+                offset = start + length
+                yield decodePath(mm[start:offset]), size, datetime, None
+            return
+        unpack = snapshotRecord.unpack_from
+        recordSize = snapshotRecord.size
+        for _ in range(self.count):
+            size, datetime, length, hashLength = unpack(mm, offset)
+            start = offset + recordSize
+            end = start + length
+            offset = end + hashLength
+            yield decodePath(mm[start:end]), size, datetime, decodeHash(mm[end:offset]) if hashLength else None
+
+    def __iter__ (self):
+        for key, entry in self.items():
+            yield key
+
+    def keys (self):
+        return iter(self)
+
+    def close (self):
+        self.mm.close()
+
+
+def isSnapshot (path):
+    with open(path, 'rb') as f:
+        return f.read(len(snapshotMagic)) == snapshotMagic
+
+
+class SnapshotWriter (object):
+    # Streams records, added in sorted path order, to a new snapshot.  Their offsets go to a temporary index file,
+    # which is appended at the end.  Written to a temporary name and renamed into place by close(), so an
+    # interrupted write never replaces a good snapshot.
+    def __init__ (self, outfile):
+        self.outfile = outfile
+        self.of = open(outfile + '_tmp', 'wb')
+        self.of.write(snapshotHeader.pack(snapshotMagic, snapshotVersion, 0, 0, 0, 0))
+        self.index = tempfile.TemporaryFile()
+        self.offset = snapshotHeader.size
+        self.count = 0
+        self.crc = 0
+
+    def add (self, key, entry):
+        self.addRecord (key, entry['size'], entry['datetime'], entry['hash'])
+
+    def addRecord (self, key, size, datetime, hash=None):
+        path = encodePath(key)
+        hash = encodeHash(hash)
+        record = snapshotRecord.pack(size, datetime, len(path), len(hash)) + path + hash
+        self.of.write(record)
+        self.crc = zlib.crc32(record, self.crc)
+        self.index.write(snapshotOffset.pack(self.offset))
+        self.offset += len(record)
+        self.count += 1
+
+    def close (self):
+        self.index.seek(0)
+        for chunk in iter(lambda: self.index.read(1 << 20), b''):
+            self.of.write(chunk)
+            self.crc = zlib.crc32(chunk, self.crc)
+        self.index.close()
+        self.of.seek(0)
+        self.of.write(snapshotHeader.pack(snapshotMagic, snapshotVersion, 0, self.count, self.offset, self.crc & 0xffffffff))
+        self.of.close()
+        os.rename(self.outfile + '_tmp', self.outfile)
+
+    def abort (self):
+        self.index.close()
+        self.of.close()
+        os.remove(self.outfile + '_tmp')
+
+
+def writeSnapshot (outfile, d):
+    writer = SnapshotWriter (outfile)
+    for key in sorted(d):
+        writer.add (key, d[key])
+    writer.close()
+
+
+# ***** Streaming mode *****
+# With --StreamBuffer MB the Now listings are not held in memory.  rclone lsl output is sorted externally:  runs of
+# about that many MB are sorted in memory and spilled to temporary files in the working directory, then merged
+# into a snapshot.  The deltas are found in the usual merge pass over the four snapshots, and the lsl files for the
+# next run are written by merging the Now snapshots with this run's operations.  Memory then depends on the buffer
+# and the number of changes, not the number of files.
+
+def sortToSnapshot (records, outfile):
+    # External sort of (key, size, datetime, hash) records into a snapshot.  Returns the SnapshotList.
+    limit = int(streamBuffer * (1 << 20))
+    runs = []
+    run = []
+    used = 0
+    try:
+        for record in records:
+            run.append (record)
+            used += 200 + len(record[0])            # Rough size of the tuple, path and ints
+            if used >= limit:
+                runs.append (spillRun (run))
+                run = []
+                used = 0
+        run.sort()
+        if runs:
+            runs.append (spillRun (run))
+            run = None
+            stream = heapq.merge(*[readRun (f) for f in runs])
+        else:
+            stream = iter(run)
+        writer = SnapshotWriter (outfile)
+        last = None
+        for key, size, datetime, hash in stream:
+            if key != last:                         # Some remotes allow duplicate names.  Keep one.
+                writer.addRecord (key, size, datetime, hash)
+                last = key
+        writer.close()
+    finally:
+        for f in runs:
+            f.close()
+    return SnapshotList (outfile)
+
+
+def spillRun (run):
+    run.sort()
+    f = tempfile.TemporaryFile(dir=localWD)
+    pack = snapshotRecord.pack
+    for key, size, datetime, hash in run:
+        path = encodePath(key)
+        hash = encodeHash(hash)
+        f.write(pack(size, datetime, len(path), len(hash)) + path + hash)
+    f.seek(0)
+    return f
+
+
+def readRun (f):
+    unpack = snapshotRecord.unpack
+    recordSize = snapshotRecord.size
+    while True:
+        head = f.read(recordSize)
+        if not head:
+            return
+        size, datetime, length, hashLength = unpack(head)
+        yield decodePath(f.read(length)), size, datetime, decodeHash(f.read(hashLength))
+
+
+def mergeItems (*streams):
+    # Merge join of (key, entry) streams in sorted key order.  Yields each key with a list of its entry in each
+    # stream, None where a stream doesn't have it.
+    streams = [iter(stream) for stream in streams]
+    heads = [next(stream, None) for stream in streams]
+    while True:
+        key = None
+        for head in heads:
+            if head is not None and (key is None or head[0] < key):
+                key = head[0]
+        if key is None:
+            return
+        entries = []
+        for i, head in enumerate(heads):
+            if head is not None and head[0] == key:
+                entries.append (head[1])
+                heads[i] = next(streams[i], None)
             else:
-                logging.warning ("Something wrong with this line in {}:\n   <{}>".format(infile, line))
+                entries.append (None)
+        yield key, entries
+
+
+def streamLocalList (localNow, remoteNow, ops, outfile):
+    # updateLocalList for streaming mode:  the Local listing is written straight to outfile from the localNow
+    # snapshot merged with the operations.  Returns False if a file did not arrive as expected.
+    toLocal, toLocalRemote, localCopies, localMoves, localDeletes, movedLocal = ops
+    removed = set(localDeletes) | set(localMoves) | set(old for old, new in movedLocal)
+    added = {}
+    for old, new in movedLocal:
+        added[new] = localNow[old]
+    for key in localCopies + localMoves:
+        added[key + '_LOCAL'] = localNow[key]
+    created = {}
+    for key in toLocal:
+        created[key] = remoteNow[key]
+    for key in toLocalRemote:
+        created[key + '_REMOTE'] = remoteNow[key]
+    for key in created:
+        path = localRoot + '/' + key
+        if not os.path.isfile(path) or os.path.getsize(path) != created[key]['size']:
+            logging.warning (printMsg ("LOCAL", "  Copied file not as expected", key))
+            return False
+    added.update (created)
+
+    writer = SnapshotWriter (outfile)
+    for key, (now, new) in mergeItems (localNow.items(), ((key, added[key]) for key in sorted(added))):
+        if new is not None:
+            writer.add (key, new)
+        elif key not in removed:
+            writer.add (key, now)
+    writer.close()
+    return True
+
+
+def streamRemoteList (listBase, newLocal, remoteNow, touched, filterSwitches, fullSync, outfile):
+    # updateRemoteList for streaming mode.  The uncertain paths are written to the --files-from list as they are
+    # found, their targeted listing is sorted to a snapshot, and the Remote listing is written straight to outfile.
+    def keep (loc, rem, key):
+        return rem is not None and key not in touched and rem.size == loc.size and \
+            not (fullSync and rem.datetime != loc.datetime)
+
+    listFile = listBase + '_remoteTouched'
+    uncertain = 0
+    with open(listFile, 'w') as of:
+        for key, (loc, rem) in mergeItems (newLocal.items(), remoteNow.items()):
+            if loc is not None and not keep (loc, rem, key):
+                of.write('/' + key + '\n')
+                uncertain += 1
+    listed = FileList ()
+    try:
+        if uncertain:
+            listed, = listTrees ((remoteName, filterSwitches + ['--files-from', listFile], listBase + '_remoteListed'))
+    except IOError as e:
+        logging.warning (printMsg ("REMOTE", "  Uploaded file lookup failed", e))
+        return False
+    finally:
+        os.remove(listFile)
+
+    writer = SnapshotWriter (outfile)
+    try:
+        for key, (loc, rem, lst) in mergeItems (newLocal.items(), remoteNow.items(), listed.items()):
+            if loc is None:
+                continue
+            if keep (loc, rem, key):
+                writer.add (key, rem)
+            elif lst is not None:
+                writer.add (key, lst)
+            else:
+                logging.warning (printMsg ("REMOTE", "  Uploaded file not found", key))
+                writer.abort()
+                return False
+        writer.close()
+    finally:
+        listed.close()
+        if uncertain:
+            os.remove(listBase + '_remoteListed')
+    return True
+
+
+def loadPrior (path):
+    # Prior sync listings are snapshots.  A listing still in rclone lsl text form (from before the snapshot format,
+    # or just written by --FirstSync) is imported into a snapshot in place.
+    if not isSnapshot(path):
+        logging.info (printMsg ("", "Importing lsl text file to snapshot", path))
+        writeSnapshot (path, loadList (path))
+    return SnapshotList (path)
+
+
+def exportLists ():
+    # Write the prior sync snapshots back out as rclone lsl text files, for debugging
+    listFiles = [localWD + remoteName[0:-1] + '_localLSL', localWD + remoteName[0:-1] + '_remoteLSL']
+    shardsDir = localWD + remoteName[0:-1] + '_shards/'
+    if os.path.isdir(shardsDir):
+        listFiles = [shardsDir + name for name in sorted(os.listdir(shardsDir)) if name.endswith(('_localLSL', '_remoteLSL'))]
+    for listFile in listFiles:
+        if not os.path.exists(listFile):
+            logging.warning (printMsg ("*****", "No prior sync listing", listFile))
+            continue
+        if isSnapshot(listFile):
+            snapshot = SnapshotList (listFile)
+            writeList (listFile + '.txt', snapshot)
+            snapshot.close()
+        else:
+            shutil.copyfile (listFile, listFile + '.txt')
+        logging.warning (printMsg ("", "Exported", listFile + '.txt'))
+
 
-    return collections.OrderedDict(sorted(d.items()))       # return a sorted list
+# ***** Multiple pairs (--Config) *****
+# With --Config one RCloneSync process syncs many Remote/Local pairs, each named by a section of an INI file:
+#
+#   [RCloneSync]                    Settings for the run as a whole (optional)
+#   Workers = 4                     Pairs synced at once
+#   Report = /home/xxx/RCloneSyncWD/report.json     Also write the combined report here
+#
+#   [Limits]                        Pairs of a group synced at once, e.g. to stay within an API quota (optional)
+#   Dropbox = 2
+#
+#   [DBox]                          One section per pair
+#   Cloud = Dropbox:
+#   LocalRoot = /mnt/raid1/share/public/DBox/Dropbox
+#   Switches = --ExcludeListFile /home/xxx/RCloneSyncWD/Dropbox_Excludes   Any other switches (optional)
+#   WorkDir = /home/xxx/RCloneSyncWD/           (optional, default --WorkDir or localWD)
+#   Group = Dropbox                             (optional, default the Cloud name)
+#
+# Values in a [DEFAULT] section apply to every pair.  Each pair is an RCloneSync run of its own (the run state is
+# module-wide), started with the switches given on the command line, then the pair's Switches.  It takes a lock
+# file named after the lsl files it updates (/tmp/RCloneSync_LOCK_<real WorkDir path>_<Cloud>, with every
+# character but letters, digits and _.- as _) rather than the single shared one, so that two config files, or a
+# renamed section, can't sync the same lsl files at once.  Its log is passed on as a block
+# when it finishes.  The combined report gives each pair's status and timing, from its <remote>_metrics.jsonl line.
+
+try:
+    import configparser                     # Python 3
+except ImportError:
+    import ConfigParser as configparser
+
+pairSettings = 'RCloneSync'
+pairLimits = 'Limits'
+
+
+def readPairs (configFile, clouds):
+    # Returns the pairs, the number of workers, the report file and the group limits, or None if the file is bad
+    config = configparser.RawConfigParser()
+    config.optionxform = str                # Keep the case of the group names
+    try:
+        if not config.read(configFile):
+            logging.error (printMsg ("*****", "Cannot read config file", configFile))
+            return None
+        defaults = config.defaults()
+        settings = dict((key, config.get(pairSettings, key)) for key in config.options(pairSettings)
+                        if key not in defaults) if config.has_section(pairSettings) else {}
+        workers = int(settings.get('Workers', 4))
+        limits = {}
+        if config.has_section(pairLimits):
+            for key in config.options(pairLimits):
+                if key not in defaults:
+                    limits[key] = int(config.get(pairLimits, key))
+    except (configparser.Error, ValueError) as e:
+        logging.error (printMsg ("*****", "Bad config file " + configFile, e))
+        return None
+
+    pairs = []
+    listFiles = {}
+    for name in config.sections():
+        if name in (pairSettings, pairLimits):
+            continue
+        pair = dict(config.items(name))
+        pair['name'] = name
+        if 'Cloud' not in pair or 'LocalRoot' not in pair:
+            logging.error (printMsg ("*****", "Pair needs a Cloud and a LocalRoot", name))
+            return None
+        if pair['Cloud'] not in clouds:
+            logging.error (printMsg ("*****", "No such rclone remote " + pair['Cloud'], name))
+            return None
+        pair['switches'] = shlex.split(pair.get('Switches', ''))
+        if pairSwitch (pair['switches'], ('--Daemon', '--ExportLists', '--Config')):
+            logging.error (printMsg ("*****", "--Daemon, --ExportLists and --Config can't be used in a pair", name))
+            return None
+        pair['workDir'] = os.path.join(pair.get('WorkDir', localWD), '')
+        pair['group'] = pair.get('Group', pair['Cloud'][0:-1])
+        listFile = os.path.realpath(pair['workDir']) + '/' + pair['Cloud'][0:-1]
+        pair['lock'] = lockfile + '_' + ''.join(c if c.isalnum() or c in '_.-' else '_' for c in listFile)
+        if listFile in listFiles:
+            logging.error (printMsg ("*****", "Pairs share the same lsl files", listFiles[listFile] + ', ' + name))
+            return None
+        listFiles[listFile] = name
+        pairs.append (pair)
+    if not pairs:
+        logging.error (printMsg ("*****", "No pairs in config file", configFile))
+        return None
+    return pairs, workers, settings.get('Report'), limits
+
+
+def pairSwitch (switches, names):
+    # Whether any of the switches is one of the named ones, or an abbreviation argparse would take for one
+    for switch in switches:
+        switch = switch.split('=', 1)[0]
+        if len(switch) > 2 and switch.startswith('--') and any(name.startswith(switch) for name in names):
+            return True
+    return False
+
+
+def runPairs (configFile, clouds, switches):
+    # Sync each pair of the config file, as an RCloneSync run with these switches added.  Returns 1 if any failed.
+    config = readPairs (configFile, clouds)
+    if config is None:
+        return 1
+    pairs, workers, reportFile, limits = config
+    gates = dict((pair['group'], threading.BoundedSemaphore(limits.get(pair['group'], workers))) for pair in pairs)
+    outputLock = threading.Lock()
+    start = time.time()
+
+    def job (pair):
+        queued = time.time()
+        with gates[pair['group']]:
+            return runPair (pair, switches, outputLock, time.time() - queued)
+
+    # Interleave the groups, so that workers don't all wait on the limit of one group
+    groups = []
+    byGroup = {}
+    for pair in pairs:
+        if pair['group'] not in byGroup:
+            groups.append (pair['group'])
+            byGroup[pair['group']] = []
+        byGroup[pair['group']].append (pair)
+    order = []
+    for rank in range(max(len(byGroup[group]) for group in groups)):
+        order += [byGroup[group][rank] for group in groups if rank < len(byGroup[group])]
+    logging.warning (">>>>> Syncing {} pairs, {} at a time".format(len(pairs), min(workers, len(pairs))))
+    results = runPool ([lambda pair=pair: job(pair) for pair in order], workers)
+    byName = dict((pair['name'], result or {'pair': pair['name'], 'cloud': pair['Cloud'], 'localRoot': pair['LocalRoot'],
+                                            'status': 'failed'}) for pair, result in zip(order, results))
+    results = [byName[pair['name']] for pair in pairs]
+
+    report = {'start': round(start, 3), 'seconds': round(time.time() - start, 3), 'pairs': results}
+    for status in ('ok', 'failed', 'not run'):
+        report[status.replace(' ', '')] = sum(1 for result in results if result['status'] == status)
+    logging.warning (">>>>> Pairs:  {ok} ok, {failed} failed, {notrun} not run, in {seconds:.1f}s".format(**report))
+    for result in results:
+        counts = result.get('counts', {})
+        logging.warning (printMsg (result['status'].upper(), "  " + result['pair'],
+                         "{:.1f}s (waited {:.1f}s), {} Local / {} Remote change(s), {} subprocesses".format(
+                         result.get('seconds', 0), result.get('waited', 0), counts.get('localChanges', 0),
+                         counts.get('remoteChanges', 0), result.get('subprocesses', 0))))
+    if reportFile:
+        try:
+            with open(reportFile + '_tmp', 'w') as of:
+                json.dump(report, of, sort_keys=True, indent=1)
+            os.rename(reportFile + '_tmp', reportFile)
+        except (IOError, OSError) as e:
+            logging.warning (printMsg ("*****", "Could not write report", e))
+    return 1 if report['failed'] or report['notrun'] else 0
+
+
+def runPair (pair, switches, outputLock, waited):
+    # One pair's RCloneSync run, in a process of its own.  Its status comes from the line it adds to the metrics file.
+    metricsFile = pair['workDir'] + pair['Cloud'][0:-1] + '_metrics.jsonl'
+    runs = 0
+    if os.path.exists(metricsFile):
+        with open(metricsFile) as f:
+            runs = sum(1 for line in f)
+    cmd = ([sys.executable, os.path.abspath(__file__), pair['Cloud'], pair['LocalRoot']] + switches +
+           ['--WorkDir', pair['workDir'], '--LockFile', pair['lock']] + pair['switches'])
+    logging.info (printMsg ("PAIR", "  Starting " + pair['name'], ' '.join(cmd[2:])))
+    start = time.time()
+    with tempfile.TemporaryFile() as log:
+        exitCode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+        log.seek(0)
+        with outputLock:
+            sys.stderr.write("----- {} ({})\n".format(pair['name'], pair['Cloud']))
+            sys.stderr.flush()
+            shutil.copyfileobj(log, getattr(sys.stderr, 'buffer', sys.stderr))
+            sys.stderr.flush()
+
+    result = {'pair': pair['name'], 'cloud': pair['Cloud'], 'localRoot': pair['LocalRoot'], 'group': pair['group'],
+              'waited': round(waited, 3), 'seconds': round(time.time() - start, 3), 'status': 'not run'}
+    summary = None
+    if os.path.exists(metricsFile):
+        with open(metricsFile) as f:
+            lines = f.readlines()
+        if len(lines) > runs:
+            summary = json.loads(lines[-1])
+    if summary is not None:
+        result['status'] = 'ok' if summary['rc'] == 0 and exitCode == 0 else 'failed'
+        for key in ('rc', 'phases', 'subprocesses', 'counts'):
+            result[key] = summary[key]
+    elif exitCode != 0:
+        result['status'] = 'failed'
+    return result
 
 
 lockfile = "/tmp/RCloneSync_LOCK"
 def requestLock (caller):
+    lockedBy = ''
     for xx in range(5):
-        if os.path.exists(lockfile):
-            with open(lockfile) as fd:
-                lockedBy = fd.read()
-                logging.debug ("{}.  Waiting a sec.".format(lockedBy[:-1]))   # remove the \n
+        try:                                # Created only if there is none, so two runs can't both take it
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                with open(lockfile) as f:
+                    lockedBy = f.read()
+                    logging.debug ("{}.  Waiting a sec.".format(lockedBy[:-1]))   # remove the \n
+            except (IOError, OSError) as e:
+                if e.errno == errno.ENOENT:         # Released meanwhile
+                    continue
+                raise
+            if staleLock (lockedBy):
+                logging.warning ("Removing stale lock file, its process is gone.  {}".format(lockedBy[:-1]))
+                removeStaleLock (lockedBy)
+                continue
             time.sleep (1)
-        else:  
-            with open(lockfile, 'w') as fd:
-                fd.write("Locked by {} at {}\n".format(caller, time.asctime(time.localtime())))
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write("Locked by {} at {} pid {}\n".format(caller, time.asctime(time.localtime()), os.getpid()))
                 logging.debug ("LOCKed by {} at {}.".format(caller, time.asctime(time.localtime())))
             return 0
     logging.warning ("Timed out waiting for LOCK file to be cleared.  {}".format(lockedBy))
     return -1
         
 
+def removeStaleLock (lockedBy):
+    # Remove the lock file if it still holds lockedBy.  It is renamed aside first and checked there, so that of two
+    # runs removing the same stale lock, the second can't remove a lock the first has taken since.
+    aside = lockfile + '_stale{}'.format(os.getpid())
+    try:
+        os.rename(lockfile, aside)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return                                  # Removed by another run already
+    with open(aside) as f:
+        current = f.read()
+    if current != lockedBy:                     # Taken since:  put it back
+        try:
+            os.link(aside, lockfile)
+        except OSError:
+            pass
+    os.remove(aside)
+
+
+def staleLock (lockedBy):
+    # A lock file is stale if the process named in it is no longer running (on this host).  Lock files from before
+    # the pid was recorded are never taken as stale.
+    words = lockedBy.split()
+    if len(words) < 2 or words[-2] != 'pid' or not words[-1].isdigit():
+        return False
+    try:
+        os.kill(int(words[-1]), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
 def releaseLock (caller):
     if os.path.exists(lockfile):
         with open(lockfile) as fd:
@@ -403,33 +3214,101 @@ if __name__ == '__main__':
     except:
         logging.error (printMsg ("ERROR*****", "rclone not installed?", ''))
         exit()
-    clouds = clouds.split()
+    clouds = clouds.decode('utf-8').split()
 
     parser = argparse.ArgumentParser(description="***** BiDirectional Sync for Cloud Services using RClone *****")
-    parser.add_argument('Cloud',        help="Name of remote cloud service", choices=clouds)
-    parser.add_argument('LocalRoot',    help="Path to local root", default=None)
+    parser.add_argument('Cloud',        help="Name of remote cloud service", choices=clouds, nargs='?')
+    parser.add_argument('LocalRoot',    help="Path to local root", default=None, nargs='?')
     parser.add_argument('--FirstSync',  help="First run setup.  WARNING: Local files may overwrite Remote versions", action='store_true')
     parser.add_argument('--ExcludeListFile', help="File containing rclone file/path exclusions (Needed for Dropbox)", default=None)
     parser.add_argument('--Verbose',    help="Event logging with per-file details (Python INFO level - default is WARNING level)", action='store_true')
     parser.add_argument('--DryRun',     help="Go thru the motions - No files are copied/deleted", action='store_true')
+    parser.add_argument('--FullRelist', help="Re-list both trees with rclone lsl after the sync rather than updating the lsl files incrementally", action='store_true')
+    parser.add_argument('--ExportLists', help="Write the prior sync snapshots out as rclone lsl text files (<file>.txt in the working directory) and exit", action='store_true')
+    parser.add_argument('--Transfers',  help="Number of file transfers run in parallel by each rclone copy (default 4)", type=int, default=4)
+    parser.add_argument('--Checkers',   help="Number of checkers run in parallel by each rclone copy (default 8)", type=int, default=8)
+    parser.add_argument('--WorkDir',    help="Working directory for the lsl files and run state (default " + localWD + ")", default=None)
+    parser.add_argument('--QuickCheck', help="Skip the run if a quick check finds no changes since the last full run, at most N runs in a row (default 0, off)", type=int, default=0, metavar='N')
+    parser.add_argument('--StreamBuffer', help="Streaming mode:  sort the listings on disk, using about this many MB of memory per listing, rather than holding them in memory (default 0, off)", type=int, default=0, metavar='MB')
+    parser.add_argument('--Daemon',     help="Keep running, syncing every --DaemonInterval seconds.  Local changes are tracked with inotify (or polling)", action='store_true')
+    parser.add_argument('--DaemonInterval', help="Seconds between --Daemon cycles (default 60)", type=int, default=60)
+    parser.add_argument('--RemoteInterval', help="Seconds between full Remote listings in --Daemon mode (default 900)", type=int, default=900)
+    parser.add_argument('--Sharded',    help="Split the tree into shards (top-level directories) that are listed, diffed and synced separately", action='store_true')
+    parser.add_argument('--ShardDirs',  help="Comma separated directory paths to use as the shards instead of the top-level directories", default=None)
+    parser.add_argument('--ShardWorkers', help="Number of shards worked on at once (default 4)", type=int, default=4)
+    parser.add_argument('--LsJson',     help="List the trees with rclone lsjson rather than rclone lsl", action='store_true')
+    parser.add_argument('--HashType',   help="Keep content hashes of this type (e.g. md5, sha1, dropbox, quickxor - one the Remote supports) in the listings and compare by hash where both sides have one.  Implies --LsJson", default=None)
+    parser.add_argument('--DetectMoves', help="Repeat a file or folder move on the other side with rclone moveto, rather than copying the files again", action='store_true')
+    parser.add_argument('--MoveHash',   help="With --DetectMoves, also require the content hashes (rclone lsjson --hash) of a moved file to agree.  Implies --DetectMoves", action='store_true')
+    parser.add_argument('--TargetedPush', help="Upload and delete just the changed paths on the Remote rather than running rclone sync over the whole tree", action='store_true')
+    parser.add_argument('--ReconcileEvery', help="With --TargetedPush, do a full rclone sync every N runs (default 0, never)", type=int, default=0, metavar='N')
+    parser.add_argument('--Config',     help="Sync each Remote/Local pair of this INI file, several at once, in place of Cloud and LocalRoot.  The other switches apply to every pair", default=None)
+    parser.add_argument('--LockFile',   help="Lock file (default " + lockfile + ")", default=None)
+    parser.add_argument('--PromFile',   help="Also write the run metrics to this file for the Prometheus node_exporter textfile collector (name it <x>.prom)", default=None)
     args = parser.parse_args()
+    if (args.Config is None) != (args.Cloud is not None and args.LocalRoot is not None):
+        parser.error("Give Cloud and LocalRoot, or --Config")
+
+    if args.WorkDir:
+        localWD  = os.path.join(args.WorkDir, '')
+    if args.LockFile:
+        lockfile = args.LockFile
+
+    if args.Config:
+        if args.Daemon or args.ExportLists:
+            parser.error("--Daemon and --ExportLists can't be used with --Config")
+        if args.Verbose:
+            logging.getLogger().setLevel(logging.INFO)
+        argv = sys.argv[1:]
+        for i, arg in enumerate(argv):
+            if pairSwitch ([arg], ['--Config']):
+                del argv[i:i+1 if '=' in arg else i+2]
+                break
+        if runPairs (args.Config, clouds, argv):
+            logging.error ('***** Error abort *****')
+        logging.warning (">>>>> All done.\n\n")
+        exit()
 
     remoteName   = args.Cloud
-    remoteNameSP = remoteName + ' '           # Space on end added to keep the subprocess call code clean
     localRoot    = args.LocalRoot
-    localRootSP  = args.LocalRoot + ' '
     firstSync    = args.FirstSync
     verbose      = args.Verbose
     exclusions   = args.ExcludeListFile
     dryRun       = args.DryRun
+    fullRelist   = args.FullRelist
+    transfers    = args.Transfers
+    checkers     = args.Checkers
+    quickCheckRuns = args.QuickCheck
+    streamBuffer = args.StreamBuffer
+    daemonInterval = args.DaemonInterval
+    remoteInterval = args.RemoteInterval
+    sharded      = args.Sharded or args.ShardDirs is not None
+    shardDirs    = args.ShardDirs
+    shardWorkers = args.ShardWorkers
+    promFile     = args.PromFile
+    targetedPush = args.TargetedPush
+    reconcileEvery = args.ReconcileEvery
+    detectMoves  = args.DetectMoves or args.MoveHash
+    lsJson       = args.LsJson or args.HashType is not None
+    hashType     = args.HashType
+    moveHash     = args.MoveHash
 
     if verbose:
         logging.getLogger().setLevel(logging.INFO)      # Log each file transaction
     else:
         logging.getLogger().setLevel(logging.WARNING)   # Log only unusual events
 
-    if requestLock (sys.argv) == 0:
-        if main():
+    if args.ExportLists:
+        exportLists ()
+        exit()
+
+    if args.Daemon:
+        if daemon():                                    # Takes the lock for each cycle
+            logging.error ('***** Error abort *****')
+    elif requestLock (sys.argv) == 0:
+        rc = main()
+        writeMetrics (rc)
+        if rc:
             logging.error ('***** Error abort *****')
         releaseLock (sys.argv)
     else:  logging.warning ("Prior lock file in place.  Aborting.")
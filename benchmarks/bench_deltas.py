@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#==========================================================
+#
+#  Benchmark the RCloneSync.findDeltas delta engine against the original per-side dictionary loops
+#
+#  Usage
+#   ./bench_deltas.py [--entries 1000000] [--churn 0.01]
+#
+#  Builds synthetic Prior and Now listings for Local and Remote, with --churn of the paths changed, deleted or
+#  new on each side, and times the delta computation only.  Each implementation runs in its own child process:
+#    legacy     the two copy-pasted loops from main(), with per-path lookups and the OrderedDict re-sort, over
+#               listings in the original loadList form (an OrderedDict of {'size': str, 'datetime': float} dicts)
+#    memory     findDeltas over in-memory FileLists (dict lookups, as --Daemon runs it)
+#    snapshot   findDeltas with the Prior listings read from snapshot files, as main() runs it (a merge pass)
+#  extra MB is the peak RSS of the delta computation over the RSS before it (Linux:  VmHWM, reset through
+#  /proc/self/clear_refs.  Elsewhere ru_maxrss, which only shows growth past the peak of building the listings).
+#
+#==========================================================
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import RCloneSync
+from RCloneSync import FileEntry, FileList, printMsg
+
+
+def makeListings (count, churn, seed=1):
+    rnd = random.Random(seed)
+    base = 1500000000 * 1000000000
+    prior = {}
+    for i in range(count):
+        key = 'dir{}/sub{}/file{}.dat'.format(rnd.randint(0, 999), rnd.randint(0, 99), i)
+        prior[key] = FileEntry (rnd.randint(0, 50000000), base + rnd.randint(0, 10**17))
+    listings = []
+    for side in range(2):
+        now = dict(prior)
+        for key in rnd.sample(sorted(prior), int(count * churn)):
+            change = rnd.randint(0, 2)
+            if change == 0:
+                del now[key]
+            elif change == 1:
+                now[key] = FileEntry (prior[key].size + 1, prior[key].datetime + 10**9)
+            else:
+                now[key + '.new{}'.format(side)] = FileEntry (1, base)
+        listings.append (FileList (dict(prior)))
+        listings.append (FileList (now))
+    return listings                         # localPrior, localNow, remotePrior, remoteNow
+
+
+def legacyDeltas (localPrior, localNow, locale):
+    # The original loop from main(), as run once for Local and once for Remote
+    localDeltas = {}
+    for key in localPrior:
+        _newer=False; _older=False; _size=False; _deleted=False
+        if key not in localNow:
+            logging.info (printMsg (locale, "  File was deleted", key))
+            _deleted=True
+        else:
+            if localPrior[key]['datetime'] != localNow[key]['datetime']:
+                if localPrior[key]['datetime'] < localNow[key]['datetime']:
+                    logging.info (printMsg (locale, "  File is newer", key))
+                    _newer=True
+                else:
+                    logging.info (printMsg (locale, "  File is OLDER", key))
+                    _older=True
+            if localPrior[key]['size'] != localNow[key]['size']:
+                logging.info (printMsg (locale, "  File size is different", key))
+                _size=True
+
+        if _newer or _older or _size or _deleted:
+            localDeltas[key] = {'new':False, 'newer':_newer, 'older':_older, 'size':_size, 'deleted':_deleted}
+
+    for key in localNow:
+        if key not in localPrior:
+            logging.info (printMsg (locale, "  File is new", key))
+            localDeltas[key] = {'new':True, 'newer':False, 'older':False, 'size':False, 'deleted':False}
+
+    return collections.OrderedDict(sorted(localDeltas.items()))
+
+
+def legacyList (listing):
+    # A FileList as the original loadList returned it
+    return collections.OrderedDict((key, {'size': str(entry.size), 'datetime': entry.datetime / 1e9})
+                                   for key, entry in listing.items())
+
+
+def procStatusKB (field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def resetPeak ():
+    # Start a new peak RSS measurement.  Returns the RSS to measure from.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')                    # Resets VmHWM to the current RSS
+        rss = procStatusKB ('VmRSS')
+        if rss is not None and procStatusKB ('VmHWM') is not None:
+            return rss
+    except IOError:
+        pass
+    return maxRssKB ()
+
+
+def peakKB ():
+    peak = procStatusKB ('VmHWM')
+    return peak if peak is not None else maxRssKB ()
+
+
+def maxRssKB ():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def child (impl, count, churn):
+    localPrior, localNow, remotePrior, remoteNow = makeListings (count, churn)
+    for listing in (localPrior, localNow, remotePrior, remoteNow):
+        list(listing)                       # Sort up front, as loadList's callers would already have done
+    workDir = None
+    if impl == 'snapshot':
+        workDir = tempfile.mkdtemp(prefix='bench_deltas_')
+        RCloneSync.writeSnapshot (os.path.join(workDir, 'local'), localPrior)
+        RCloneSync.writeSnapshot (os.path.join(workDir, 'remote'), remotePrior)
+        localPrior = RCloneSync.SnapshotList (os.path.join(workDir, 'local'))
+        remotePrior = RCloneSync.SnapshotList (os.path.join(workDir, 'remote'))
+    elif impl == 'legacy':
+        localPrior, localNow, remotePrior, remoteNow = [legacyList (listing) for listing in
+                                                        (localPrior, localNow, remotePrior, remoteNow)]
+
+    before = resetPeak()
+    start = time.time()
+    if impl == 'legacy':
+        localDeltas = legacyDeltas (localPrior, localNow, "LOCAL")
+        remoteDeltas = legacyDeltas (remotePrior, remoteNow, "REMOTE")
+    else:
+        localDeltas, remoteDeltas = RCloneSync.findDeltas (localPrior, localNow, remotePrior, remoteNow)
+    elapsed = time.time() - start
+    print(json.dumps({'local': len(localDeltas), 'remote': len(remoteDeltas), 'seconds': elapsed,
+                      'extraKB': peakKB() - before}))
+    if workDir:
+        shutil.rmtree(workDir)
+
+
+def main ():
+    parser = argparse.ArgumentParser(description="Benchmark RCloneSync.findDeltas against the original delta loops")
+    parser.add_argument('--entries', help="Paths per listing", type=int, default=1000000)
+    parser.add_argument('--churn',   help="Fraction of paths changed on each side", type=float, default=0.01)
+    parser.add_argument('--child',   nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child (args.child[0], int(args.child[1]), float(args.child[2]))
+        return
+
+    print("{:>9}  {:9}  {:>8}  {:>8}  {:>9}  {:>10}".format('entries', 'impl', 'local', 'remote', 'seconds', 'extra MB'))
+    for impl in ('legacy', 'memory', 'snapshot'):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', impl,
+                                       str(args.entries), str(args.churn)])
+        r = json.loads(out.decode('utf-8'))
+        print("{:>9}  {:9}  {:>8}  {:>8}  {:>9.2f}  {:>10.1f}".format(args.entries, impl, r['local'], r['remote'],
+              r['seconds'], r['extraKB'] / 1024.0))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
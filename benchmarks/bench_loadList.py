@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#==========================================================
+#
+#  Benchmark RCloneSync.loadList parse time and peak memory on synthetic rclone lsl listings
+#
+#  Usage
+#   ./bench_loadList.py [--sizes 100000,1000000,5000000] [--legacy] [--lsjson] [--keep DIR]
+#
+#  Each load runs in its own child process so that the peak RSS (ru_maxrss) belongs to that one listing.
+#  --legacy also times the original regex/strptime/OrderedDict loadList for comparison.
+#  --lsjson also times parseLsJson on the same listing in rclone lsjson form, with an md5 hash per file.
+#
+#==========================================================
+
+import argparse
+import collections
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import RCloneSync
+
+
+def makeListing (path, count, seed=1):
+    # Synthetic lsl output:  a few thousand directories, random sizes, modtimes spread over ten years
+    rnd = random.Random(seed)
+    dirs = ['/'.join('d{}'.format(rnd.randint(0, 40)) for _ in range(rnd.randint(0, 5))) for _ in range(5000)]
+    base = time.mktime((2010, 1, 1, 0, 0, 0, 0, 0, -1))
+    with open(path, 'w') as of:
+        for i in range(count):
+            d = dirs[rnd.randint(0, len(dirs) - 1)]
+            name = (d + '/' if d else '') + 'file {} {}.dat'.format(i, rnd.randint(0, 999))
+            t = base + rnd.randint(0, 10 * 365 * 86400)
+            of.write("{:9d} {}.{:09d} {}\n".format(rnd.randint(0, 50000000),
+                     time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)), rnd.randint(0, 999999999), name))
+
+
+def makeJsonListing (lslPath, path):
+    # The same listing as rclone lsjson -R --files-only --hash --hash-type md5 would give it
+    with open(lslPath) as f, open(path, 'w') as of:
+        of.write('[\n')
+        first = True
+        for key, size, datetime, hash in RCloneSync.parseLsl (f, lslPath):
+            secs, nanos = divmod(datetime, 1000000000)
+            item = {'Path': key, 'Name': key.rsplit('/', 1)[-1], 'Size': size, 'MimeType': 'application/octet-stream',
+                    'ModTime': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(secs)) + '.{:09d}Z'.format(nanos),
+                    'IsDir': False, 'Hashes': {'md5': '{:032x}'.format(random.getrandbits(128))}}
+            of.write(('' if first else ',\n') + json.dumps(item))
+            first = False
+        of.write('\n]\n')
+
+
+lineFormat = re.compile(r'\s*([0-9]+) ([\d\-]+) ([\d:]+).([\d]+) (.*)')
+
+def legacyLoadList (infile):
+    # loadList as it was before the FileList rewrite
+    d = {}
+    with open(infile, 'r') as f:
+        for line in f:
+            out = lineFormat.match(line)
+            if out:
+                size = out.group(1)
+                date = out.group(2)
+                _time = out.group(3)
+                microsec = out.group(4)
+                date_time = time.mktime(datetime.strptime(date + ' ' + _time, '%Y-%m-%d %H:%M:%S').timetuple()) + float('.'+ microsec)
+                filename = out.group(5)
+                d[filename] = {'size': size, 'datetime': date_time}
+    return collections.OrderedDict(sorted(d.items()))
+
+
+def maxRssKB ():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def loadJson (path):
+    RCloneSync.hashType = 'md5'
+    with open(path) as f:
+        return RCloneSync.buildList (RCloneSync.parseLsJson (f, path))
+
+
+def child (impl, path):
+    load = {'legacy': legacyLoadList, 'lsjson': loadJson}.get(impl, RCloneSync.loadList)
+    before = maxRssKB()
+    start = time.time()
+    listing = load(path)
+    for key in listing:                 # Sorted iteration is part of the cost callers pay
+        pass
+    elapsed = time.time() - start
+    print(json.dumps({'entries': len(listing), 'seconds': elapsed, 'peakKB': maxRssKB(), 'baseKB': before}))
+
+
+def run (impl, path):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', impl, path])
+    return json.loads(out.decode('utf-8'))
+
+
+def main ():
+    parser = argparse.ArgumentParser(description="Benchmark RCloneSync.loadList on synthetic lsl listings")
+    parser.add_argument('--sizes',  help="Comma separated listing sizes (lines)", default='100000,1000000,5000000')
+    parser.add_argument('--legacy', help="Also run the original loadList for comparison", action='store_true')
+    parser.add_argument('--lsjson', help="Also load the listing in rclone lsjson form", action='store_true')
+    parser.add_argument('--keep',   help="Directory for the generated listings (kept between runs)", default=None)
+    parser.add_argument('--child',  nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child (*args.child)
+        return
+
+    workDir = args.keep or tempfile.mkdtemp(prefix='bench_loadList_')
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+    impls = ['current'] + (['legacy'] if args.legacy else []) + (['lsjson'] if args.lsjson else [])
+
+    print("{:>9}  {:8}  {:>9}  {:>10}  {:>12}".format('lines', 'impl', 'entries', 'seconds', 'peak MB'))
+    try:
+        for count in [int(x) for x in args.sizes.split(',')]:
+            path = os.path.join(workDir, 'lsl_{}'.format(count))
+            if not os.path.exists(path):
+                makeListing (path, count)
+            if args.lsjson and not os.path.exists(path + '.json'):
+                makeJsonListing (path, path + '.json')
+            for impl in impls:
+                r = run (impl, path + '.json' if impl == 'lsjson' else path)
+                print("{:>9}  {:8}  {:>9}  {:>10.2f}  {:>12.1f}".format(count, impl, r['entries'], r['seconds'],
+                      (r['peakKB'] - r['baseKB']) / 1024.0))
+                sys.stdout.flush()
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+#==========================================================
+#
+#  Benchmark and check whole RCloneSync.py runs on synthetic trees, offline
+#
+#  Usage
+#   ./bench_sync.py [--files 10000] [--depth 3] [--fanout 6] [--size 4096] [--churn 0.02] [--conflicts 0.005]
+#                   [--switches="--TargetedPush --HashType md5"] [--python PATH] [--rclone] [--daemon] [--keep DIR]
+#
+#  Builds a Local tree of --files files spread over --depth levels of --fanout directories, with the Remote empty,
+#  and runs RCloneSync.py on the pair three times:
+#    first      --FirstSync, which uploads the whole tree
+#    churn      after --churn of the files on each side are edited, deleted or added, and --conflicts of them are
+#               changed on both sides (edited on both, edited on one and deleted on the other, or new on both)
+#    steady     with nothing changed, which must find no changes
+#  With --daemon, then RCloneSync.py --Daemon --DaemonInterval 1 --RemoteInterval 1000, so that after its first
+#  cycle every cycle is between Remote listings:
+#    daemon1    a Local edit, with a file added on the Remote with an old modtime (which the daemon's Remote check
+#               doesn't see):  just the edit is pushed, and the Remote file must be left in place
+#    daemon2    a Local edit, with a file added on the Remote and an edit on both sides (the Remote one with an
+#               old modtime):  the Remote check must make it a Remote cycle, which brings both trees level
+#  Each run is RCloneSync.py itself, with --WorkDir in the scratch directory and --switches added, in a child
+#  process so that the peak RSS (VmHWM) is that of the sync and not of its rclone subprocesses.  The per-phase
+#  times, subprocess counts and transfer counts come from the run's line in <remote>_metrics.jsonl.  After each run
+#  both trees must hold exactly the expected files and contents, including the <key>_LOCAL and <key>_REMOTE
+#  conflict copies, and the run's log must hold no errors (an edit/delete conflict whose Local file is renamed to
+#  <key>_LOCAL must not also be uploaded as <key>, for one).  Exits 1 on any difference or error.
+#
+#  The Remote is fake_rclone/rclone, a stand-in rclone executable (put first on PATH) that keeps each remote as a
+#  plain directory.  --rclone uses the rclone on PATH instead, with the Remote an alias remote onto the same
+#  directory (the local backend).  The lock file is RCloneSync.py's usual one, so don't run it beside a live sync.
+#
+#==========================================================
+
+import argparse
+import json
+import os
+import random
+import resource
+import runpy
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(benchDir, '..', 'RCloneSync.py')
+remote = 'Bench:'
+
+
+def content (key, tag, size):
+    line = (key + ' ' + tag + '\n').encode('utf-8')
+    return (line * (size // len(line) + 1))[:size] if size > len(line) else line
+
+
+def writeFile (root, key, data, mtime):
+    path = os.path.join(root, key)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as of:
+        of.write(data)
+    os.utime(path, (mtime, mtime))
+
+
+def listTree (root):
+    keys = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            keys.add (os.path.relpath(os.path.join(dirpath, name), root).replace(os.sep, '/'))
+    return keys
+
+
+def makeTrees (args, localRoot, remoteRoot, rnd):
+    # The Local tree, and the expected content of both trees after the first sync, as key -> (key the content was made for, tag, size)
+    level = ['']
+    dirs = ['']
+    for d in range(args.depth):
+        level = [(p + '/' if p else '') + 'd{}'.format(i) for p in level for i in range(args.fanout)]
+        dirs += level
+    base = time.time() - 30 * 86400
+    expected = {'RCLONE_TEST': ('RCLONE_TEST', 'v0', 0)}
+    for i in range(args.files):
+        d = rnd.choice(dirs)
+        key = (d + '/' if d else '') + 'file{}.dat'.format(i)
+        expected[key] = (key, 'v0', rnd.randint(0, args.size))
+        writeFile (localRoot, key, content (*expected[key]), base + i * 0.001)
+    for root in (localRoot, remoteRoot):
+        writeFile (root, 'RCLONE_TEST', content (*expected['RCLONE_TEST']), base)
+    return dirs, expected
+
+
+def churn (args, localRoot, remoteRoot, dirs, expected, rnd):
+    # Change both trees, and return the expected content of both after the next sync
+    after = dict(expected)
+    keys = sorted(key for key in expected if key != 'RCLONE_TEST')
+    rnd.shuffle (keys)
+    changed = int(args.files * args.churn)
+    mtime = [time.time() - 86400]
+
+    def change (root, key, tag):
+        size = rnd.randint(0, args.size)
+        mtime[0] += 1
+        writeFile (root, key, content (key, tag, size), mtime[0])
+        return key, tag, size
+
+    for side, root in (('local', localRoot), ('remote', remoteRoot)):
+        for n in range(changed):
+            kind = n % 3
+            if kind == 0:
+                key = keys.pop()
+                after[key] = change (root, key, side)
+            elif kind == 1:
+                key = keys.pop()
+                os.remove(os.path.join(root, key))
+                del after[key]
+            else:
+                d = rnd.choice(dirs)
+                key = (d + '/' if d else '') + 'new_{}{}.dat'.format(side, n)
+                after[key] = change (root, key, side)
+
+    counts = [0, 0, 0, 0]
+    for n in range(int(args.files * args.conflicts)):
+        kind = n % 4
+        counts[kind] += 1
+        if kind == 3:                           # New on both sides:  <key>_LOCAL and <key>_REMOTE
+            d = rnd.choice(dirs)
+            key = (d + '/' if d else '') + 'new_both{}.dat'.format(n)
+            after[key] = after[key + '_LOCAL'] = change (localRoot, key, 'local')
+            after[key + '_REMOTE'] = change (remoteRoot, key, 'remote')
+            continue
+        key = keys.pop()
+        del after[key]
+        if kind == 0:                           # Edited on both sides:  Local wins, Remote's as <key>_REMOTE
+            after[key] = change (localRoot, key, 'local')
+            after[key + '_REMOTE'] = change (remoteRoot, key, 'remote')
+        elif kind == 1:                         # Edited on Local, deleted on Remote:  <key>_LOCAL
+            after[key + '_LOCAL'] = change (localRoot, key, 'local')
+            os.remove(os.path.join(remoteRoot, key))
+        else:                                   # Deleted on Local, edited on Remote:  <key>_REMOTE
+            os.remove(os.path.join(localRoot, key))
+            after[key + '_REMOTE'] = change (remoteRoot, key, 'remote')
+    print("churn: {} edits, {} deletes, {} new files on each side;  conflicts: {} edit/edit, {} edit/delete, "
+          "{} delete/edit, {} new/new".format(len(range(0, changed, 3)), len(range(1, changed, 3)),
+          len(range(2, changed, 3)), *counts))
+    return after
+
+
+def checkTrees (name, localRoot, remoteRoot, expected, remoteOnly=()):
+    # remoteOnly:  keys of expected that are on the Remote only
+    failed = 0
+    for side, root in (('Local', localRoot), ('Remote', remoteRoot)):
+        tree = listTree (root)
+        if side == 'Local':
+            tree.update (remoteOnly)
+        missing = sorted(key for key in expected if key not in tree)
+        extra = sorted(key for key in tree if key not in expected)
+        different = []
+        for key in sorted(tree):
+            if key in expected and (side == 'Remote' or key not in remoteOnly):
+                with open(os.path.join(root, key), 'rb') as f:
+                    if f.read() != content (*expected[key]):
+                        different.append (key)
+        for what, keys in (('missing', missing), ('unexpected', extra), ('wrong content', different)):
+            if keys:
+                print("MISMATCH   {} {}:  {} {} file(s), e.g. {}".format(name, side, len(keys), what, ', '.join(keys[:3])))
+                failed += 1
+    return failed
+
+
+def checkErrors (name, logFile):
+    # A run that logged an error (from itself or from rclone) fails, even if its re-list left both trees right
+    with open(logFile) as f:
+        errors = [line.strip() for line in f if 'ERROR' in line]
+    if errors:
+        print("ERRORS     {} run logged {} error(s), e.g. {}".format(name, len(errors), errors[0]))
+    return 1 if errors else 0
+
+
+def maxRssKB ():
+    # VmHWM where there is one:  on Linux ru_maxrss carries over the parent's peak from before the exec
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def child (argv):
+    # One RCloneSync.py run, as from the command line
+    sys.argv = [script] + argv
+    before = maxRssKB()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit:
+        pass
+    print(json.dumps({'peakKB': maxRssKB(), 'baseKB': before}))
+
+
+def metricsLines (workDir):
+    metricsFile = os.path.join(workDir, 'wd', remote[0:-1] + '_metrics.jsonl')
+    if not os.path.exists(metricsFile):
+        return []
+    with open(metricsFile) as f:
+        return f.readlines()
+
+
+def runSync (args, env, workDir, localRoot, name, switches):
+    syncWD = os.path.join(workDir, 'wd')
+    metricsFile = os.path.join(syncWD, remote[0:-1] + '_metrics.jsonl')
+    runs = len(metricsLines (workDir))
+    argv = [remote, localRoot, '--WorkDir', syncWD] + switches + shlex.split(args.switches)
+    with open(os.path.join(workDir, name + '.log'), 'w') as log:
+        out = subprocess.check_output([args.python, os.path.abspath(__file__), '--child'] + argv, stderr=log, env=env)
+    rss = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    with open(metricsFile) as f:
+        lines = f.readlines()
+    if len(lines) == runs:
+        return None, rss                        # The run didn't get as far as main()
+    return json.loads(lines[-1]), rss
+
+
+def runDaemon (args, env, workDir, localRoot, remoteRoot, expected, rnd):
+    # The --daemon runs.  Returns the number of failed checks.
+    argv = [remote, localRoot, '--WorkDir', os.path.join(workDir, 'wd'), '--Daemon', '--DaemonInterval', '1',
+            '--RemoteInterval', '1000'] + shlex.split(args.switches)
+    log = open(os.path.join(workDir, 'daemon.log'), 'w')
+    proc = subprocess.Popen([args.python, os.path.abspath(__file__), '--child'] + argv, stdout=subprocess.PIPE,
+                            stderr=log, env=env)
+    failed = 0
+    try:
+        cycles = len(metricsLines (workDir))
+        if waitCycle (workDir, cycles, proc) is None:       # The first cycle lists both sides
+            print("FAILED     daemon did not complete its first cycle, see {}".format(log.name))
+            return 1
+        keys = sorted(key for key in expected if key != 'RCLONE_TEST' and not key.endswith(('_LOCAL', '_REMOTE')))
+        rnd.shuffle (keys)
+        old = time.time() - 20 * 86400
+        remoteOnly = []
+        for name in ('daemon1', 'daemon2'):
+            cycles = len(metricsLines (workDir))
+            after = dict(expected)
+            added = 'daemon_' + name + '_remote.dat'
+            after[added] = (added, 'remote', rnd.randint(0, args.size))
+            writeFile (remoteRoot, added, content (*after[added]), old if name == 'daemon1' else time.time())
+            if name == 'daemon1':
+                remoteOnly.append (added)
+            else:                               # Edited on both sides:  Local wins, Remote's as <key>_REMOTE
+                key = keys.pop()
+                after[key + '_REMOTE'] = (key, 'remote', rnd.randint(0, args.size))
+                writeFile (remoteRoot, key, content (*after[key + '_REMOTE']), old)
+                after[key] = (key, 'local', rnd.randint(0, args.size))
+                writeFile (localRoot, key, content (*after[key]), time.time())
+                remoteOnly = []
+            key = keys.pop()
+            after[key] = (key, 'local', rnd.randint(0, args.size))
+            writeFile (localRoot, key, content (*after[key]), time.time())
+            expected = after
+            summary = waitCycle (workDir, cycles, proc)
+            if summary is None:
+                print("FAILED     {} cycle did not complete, see {}".format(name, log.name))
+                return failed + 1
+            report (name, summary, None)
+            if summary['rc'] != 0:
+                print("FAILED     {} cycle returned {}, see {}".format(name, summary['rc'], log.name))
+                failed += 1
+            failed += checkTrees (name, localRoot, remoteRoot, expected, remoteOnly)
+    finally:
+        proc.terminate()
+        out = proc.communicate()[0]
+        log.close()
+    rss = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    print("daemon    peak MB {:.1f}".format(rss['peakKB'] / 1024.0))
+    return failed
+
+
+def waitCycle (workDir, cycles, proc, timeout=60):
+    # The metrics of the daemon cycle after the given count, or None if the daemon exits or none comes in time
+    end = time.time() + timeout
+    while time.time() < end and proc.poll() is None:
+        lines = metricsLines (workDir)
+        if len(lines) > cycles:
+            return json.loads(lines[cycles])
+        time.sleep (0.1)
+    return None
+
+
+def report (name, summary, rss):
+    # rss None:  a daemon cycle, whose peak is the daemon's
+    counts = summary['counts']
+    print("{:8}  {:>3}  {:>8.2f}  {:>8}  {:>8}  {:>7}  {:>7}  {:>8}  {:>8}  {:>9}".format(name, summary['rc'],
+          summary['seconds'], summary['subprocesses'], '{:.1f}'.format(rss['peakKB'] / 1024.0) if rss else '-',
+          counts.get('localChanges', 0),
+          counts.get('remoteChanges', 0), counts.get('toLocalFiles', 0), counts.get('toRemoteFiles', 0),
+          counts.get('conflicts', 0)))
+    phases = sorted((item for item in summary['phases'].items() if item[1] >= 0.005), key=lambda item: -item[1])
+    print("          phases     " + ',  '.join("{} {:.2f}".format(phase, seconds) for phase, seconds in phases))
+    commands = sorted(summary['commands'].items())
+    print("          commands   " + ',  '.join("{} {}".format(command, c['count']) for command, c in commands))
+
+
+def bench (args, workDir):
+    localRoot = os.path.join(workDir, 'local')
+    remoteRoot = os.path.join(workDir, 'remotes', remote[0:-1])
+    for path in (localRoot, remoteRoot, os.path.join(workDir, 'wd')):
+        os.makedirs(path)
+    env = dict(os.environ)
+    if args.rclone:
+        config = os.path.join(workDir, 'rclone.conf')
+        with open(config, 'w') as of:
+            of.write("[{}]\ntype = alias\nremote = {}\n".format(remote[0:-1], remoteRoot))
+        env['RCLONE_CONFIG'] = config
+    else:
+        env['PATH'] = os.path.join(benchDir, 'fake_rclone') + os.pathsep + env.get('PATH', '')
+        env['FAKE_RCLONE_ROOT'] = os.path.join(workDir, 'remotes')
+
+    rnd = random.Random(args.seed)
+    start = time.time()
+    dirs, expected = makeTrees (args, localRoot, remoteRoot, rnd)
+    print("tree:  {} files in {} directories, {:.1f} MB  ({:.1f}s to build)".format(args.files, len(dirs),
+          sum(size for key, tag, size in expected.values()) / 1e6, time.time() - start))
+
+    failed = 0
+    print("{:8}  {:>3}  {:>8}  {:>8}  {:>8}  {:>7}  {:>7}  {:>8}  {:>8}  {:>9}".format('run', 'rc', 'seconds',
+          'subprocs', 'peak MB', 'local', 'remote', 'toLocal', 'toRemote', 'conflicts'))
+    for name in ('first', 'churn', 'steady'):
+        if name == 'churn':
+            expected = churn (args, localRoot, remoteRoot, dirs, expected, rnd)
+        summary, rss = runSync (args, env, workDir, localRoot, name, ['--FirstSync'] if name == 'first' else [])
+        if summary is None:
+            print("FAILED     {} run did not complete, see {}".format(name, os.path.join(workDir, name + '.log')))
+            return 1
+        report (name, summary, rss)
+        sys.stdout.flush()
+        if summary['rc'] != 0:
+            print("FAILED     {} run returned {}, see {}".format(name, summary['rc'], os.path.join(workDir, name + '.log')))
+            failed += 1
+        failed += checkErrors (name, os.path.join(workDir, name + '.log'))
+        failed += checkTrees (name, localRoot, remoteRoot, expected)
+        if failed and name == 'first':
+            print("FAILED")
+            return 1
+        if name == 'steady' and (summary['counts'].get('localChanges') or summary['counts'].get('remoteChanges')):
+            print("MISMATCH   steady run found changes")
+            failed += 1
+    if args.daemon:
+        failed += runDaemon (args, env, workDir, localRoot, remoteRoot, expected, rnd)
+    print("OK" if not failed else "FAILED")
+    return 1 if failed else 0
+
+
+def main ():
+    parser = argparse.ArgumentParser(description="Benchmark and check RCloneSync.py runs on synthetic trees")
+    parser.add_argument('--files',     help="Files in the tree", type=int, default=10000)
+    parser.add_argument('--depth',     help="Levels of directories", type=int, default=3)
+    parser.add_argument('--fanout',    help="Subdirectories per directory", type=int, default=6)
+    parser.add_argument('--size',      help="Largest file size in bytes", type=int, default=4096)
+    parser.add_argument('--churn',     help="Fraction of the files changed on each side", type=float, default=0.02)
+    parser.add_argument('--conflicts', help="Fraction of the files changed on both sides", type=float, default=0.005)
+    parser.add_argument('--seed',      help="Random seed", type=int, default=1)
+    parser.add_argument('--switches',  help="Extra RCloneSync.py switches for every run", default='')
+    parser.add_argument('--python',    help="Python interpreter for the RCloneSync.py runs", default=sys.executable)
+    parser.add_argument('--rclone',    help="Use the rclone on PATH (local backend) rather than the stand-in", action='store_true')
+    parser.add_argument('--daemon',    help="Also check --Daemon cycles between Remote listings", action='store_true')
+    parser.add_argument('--keep',      help="Scratch directory to use and keep (must not exist)", default=None)
+    parser.add_argument('--child',     nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child (args.child)
+        return 0
+
+    if args.keep:
+        workDir = args.keep
+        os.makedirs(workDir)
+    else:
+        workDir = tempfile.mkdtemp(prefix='bench_sync_')
+    try:
+        return bench (args, workDir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#==========================================================
+#
+#  Check that streaming mode (--StreamBuffer) gives the same results as the in-memory listings
+#
+#  Usage
+#   ./check_streaming.py [--entries 200000] [--churn 0.02] [--buffer 0.5] [--memory 1000000]
+#
+#  On synthetic Prior and Now listings for Local and Remote (see bench_deltas.py), compares:
+#    listing    the external sort into a snapshot (fed out of order, --buffer MB runs so that it spills) against
+#               the FileList
+#    deltas     findDeltas over the snapshots against findDeltas over the FileLists
+#    lsl file   streamLocalList against updateLocalList, for a set of deletes, copies, renames, moves and new files
+#  Exits 1 on any difference.  --memory N also reports the peak RSS of loading an N line lsl file both ways,
+#  each in its own child process.
+#
+#==========================================================
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import RCloneSync
+from RCloneSync import FileList, SnapshotList, findDeltas, sortToSnapshot, updateLocalList, streamLocalList
+from bench_deltas import makeListings
+from bench_loadList import makeListing
+
+
+def snapshotOf (listing, path, rnd):
+    records = [(key, listing[key].size, listing[key].datetime, listing[key].hash) for key in listing]
+    rnd.shuffle (records)
+    return sortToSnapshot (iter(records), path)
+
+
+def sameListing (a, b):
+    return [(key, e.size, e.datetime, e.hash) for key, e in a.items()] == [(key, e.size, e.datetime, e.hash) for key, e in b.items()]
+
+
+def sameDeltas (a, b):
+    return list(a) == list(b) and all(a[key] == b[key] for key in a)
+
+
+def check (args, workDir):
+    RCloneSync.localWD = workDir + '/'
+    RCloneSync.streamBuffer = args.buffer
+    rnd = random.Random(2)
+    failed = []
+
+    names = ('localPrior', 'localNow', 'remotePrior', 'remoteNow')
+    memory = makeListings (args.entries, args.churn)
+    for listing in memory:                  # Some entries with content hashes (--HashType)
+        for key in listing:
+            if hash(key) % 3 == 0:
+                listing[key].hash = 'md5:{:032x}'.format(hash(key) & (2**128 - 1))
+    start = time.time()
+    streamed = [snapshotOf (listing, os.path.join(workDir, name), rnd) for name, listing in zip(names, memory)]
+    print("{:10} {:>8.2f}s  sorted to snapshots".format('listing', time.time() - start))
+    for name, a, b in zip(names, memory, streamed):
+        if not sameListing (a, b):
+            failed.append ('listing ' + name)
+
+    localDeltas, remoteDeltas = findDeltas (*memory)
+    streamLocal, streamRemote = findDeltas (*streamed)
+    print("{:10} {:>8} local, {} remote changes".format('deltas', len(localDeltas), len(remoteDeltas)))
+    if not sameDeltas (localDeltas, streamLocal) or not sameDeltas (remoteDeltas, streamRemote):
+        failed.append ('deltas')
+
+    # A mix of operations, with the copied files put in place on disk for the size check
+    localNow, remoteNow = memory[1], memory[3]
+    localKeys = list(localNow)
+    remoteOnly = [key for key in remoteNow if key not in localNow]
+    ops = (rnd.sample(remoteOnly, min(50, len(remoteOnly))), rnd.sample(localKeys, 20),
+           rnd.sample(localKeys, 20), rnd.sample(localKeys, 20), rnd.sample(localKeys, 20))
+    toLocal, toLocalRemote, localCopies, localMoves, localDeletes = ops
+    localMoves = [key for key in localMoves if key not in localDeletes and key not in toLocalRemote]
+    skip = set(toLocal) | set(toLocalRemote) | set(localCopies) | set(localMoves) | set(localDeletes)
+    olds = [key for key in rnd.sample(localKeys, 40) if key not in skip][:20]
+    movedLocal = [(old, old + '.moved') for old in olds if old + '.moved' not in localNow]
+    ops = (toLocal, toLocalRemote, localCopies, localMoves, localDeletes, movedLocal)
+    RCloneSync.localRoot = os.path.join(workDir, 'local')
+    for name, keys in ((None, toLocal), ('_REMOTE', toLocalRemote)):
+        for key in keys:
+            path = os.path.join(RCloneSync.localRoot, key + (name or ''))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.truncate(remoteNow[key].size)
+    expected = FileList (updateLocalList (localNow, remoteNow, *ops))
+    outfile = os.path.join(workDir, 'newLocal')
+    if not streamLocalList (streamed[1], streamed[3], ops, outfile):
+        failed.append ('lsl file (streamLocalList failed)')
+    else:
+        newLocal = SnapshotList (outfile)
+        print("{:10} {:>8} entries".format('lsl file', len(newLocal)))
+        if not sameListing (expected, newLocal):
+            failed.append ('lsl file')
+        newLocal.close()
+    for snapshot in streamed:
+        snapshot.close()
+
+    for what in failed:
+        print("MISMATCH   " + what)
+    print("OK" if not failed else "FAILED")
+    return 1 if failed else 0
+
+
+def maxRssKB ():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def child (impl, path, buffer):
+    RCloneSync.localWD = os.path.dirname(path) + '/'
+    RCloneSync.streamBuffer = float(buffer)
+    before = maxRssKB()
+    start = time.time()
+    with open(path) as f:
+        records = RCloneSync.parseLsl (f, path)
+        if impl == 'memory':
+            listing = RCloneSync.buildList (records)
+        else:
+            listing = sortToSnapshot (records, path + '.snapshot')
+        for key in listing:
+            pass
+    print(json.dumps({'entries': len(listing), 'seconds': time.time() - start, 'peakKB': maxRssKB(), 'baseKB': before}))
+
+
+def memoryReport (args, workDir):
+    path = os.path.join(workDir, 'lsl_{}'.format(args.memory))
+    makeListing (path, args.memory)
+    print("{:>9}  {:8}  {:>10}  {:>12}".format('lines', 'impl', 'seconds', 'peak MB'))
+    for impl in ('memory', 'stream'):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', impl, path, str(args.buffer)])
+        r = json.loads(out.decode('utf-8'))
+        print("{:>9}  {:8}  {:>10.2f}  {:>12.1f}".format(r['entries'], impl, r['seconds'], (r['peakKB'] - r['baseKB']) / 1024.0))
+
+
+def main ():
+    parser = argparse.ArgumentParser(description="Check streaming mode against the in-memory listings")
+    parser.add_argument('--entries', help="Paths per listing", type=int, default=200000)
+    parser.add_argument('--churn',   help="Fraction of paths changed on each side", type=float, default=0.02)
+    parser.add_argument('--buffer',  help="Sort buffer in MB (small, so that the sort spills)", type=float, default=0.5)
+    parser.add_argument('--memory',  help="Also report peak RSS of loading an lsl file of this many lines", type=int, default=0)
+    parser.add_argument('--child',   nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child (*args.child)
+        return 0
+
+    workDir = tempfile.mkdtemp(prefix='check_streaming_')
+    try:
+        rc = check (args, workDir)
+        if args.memory:
+            memoryReport (args, workDir)
+    finally:
+        shutil.rmtree(workDir)
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main())